@@ -0,0 +1,59 @@
+import math
+
+import torch
+
+# Workspaces reused by the no-grad kernels, keyed by (dtype, device); grown on demand and never shrunk
+_WORKSPACES = {}
+
+# 0.5 * log(2 * pi) as a 0-dim tensor per (dtype, device), so it never has to be rebuilt or copied to the device
+_HALF_LOG_2PI = {}
+
+
+# Return the normalizing constant 0.5 * log(2 * pi) of a standard normal dimension.
+def half_log_2pi(dtype, device):
+    key = (dtype, torch.device(device))
+    if key not in _HALF_LOG_2PI:
+        _HALF_LOG_2PI[key] = torch.tensor(
+            0.5 * math.log(2 * math.pi), dtype=dtype, device=device
+        )
+    return _HALF_LOG_2PI[key]
+
+
+# Return a scratch tensor of the given shape, dtype and device.
+# The storage is shared between calls, so the result must be reduced before the next kernel runs.
+def _workspace(shape, dtype, device):
+    numel = torch.Size(shape).numel()
+    key = (dtype, device)
+    buffer = _WORKSPACES.get(key)
+    if buffer is None or buffer.numel() < numel:
+        buffer = torch.empty(numel, dtype=dtype, device=device)
+        _WORKSPACES[key] = buffer
+    return buffer[:numel].view(shape)
+
+
+# Log-density of obs under the diagonal Gaussian N(mu, exp(logstd)^2), summed over axis.
+# mu and logstd may broadcast against obs, e.g. (B, 1, D) parameters shared by (B, K, D) samples.
+# Without gradients the squared standardized residual is built in a reused workspace.
+def gaussian_log_prob(obs, mu, logstd, axis=1):
+    normalizer = torch.sum(logstd, axis) + obs.shape[axis] * half_log_2pi(
+        obs.dtype, obs.device
+    )
+    if torch.is_grad_enabled():
+        return (
+            -0.5 * torch.sum(((obs - mu) * torch.exp(-logstd)) ** 2, axis) - normalizer
+        )
+
+    shape = torch.broadcast_shapes(obs.shape, mu.shape, logstd.shape)
+    residual = torch.sub(obs, mu, out=_workspace(shape, obs.dtype, obs.device))
+    residual.mul_(torch.exp(-logstd)).square_()
+    return torch.sum(residual, axis).mul_(-0.5).sub_(normalizer)
+
+
+# Log-density of obs under N(0, I), summed over axis.
+def standard_normal_log_prob(obs, axis=1):
+    normalizer = obs.shape[axis] * half_log_2pi(obs.dtype, obs.device)
+    if torch.is_grad_enabled():
+        return -0.5 * torch.sum(obs**2, axis) - normalizer
+
+    squares = torch.mul(obs, obs, out=_workspace(obs.shape, obs.dtype, obs.device))
+    return torch.sum(squares, axis).mul_(-0.5).sub_(normalizer)
@@ -0,0 +1,758 @@
+import concurrent.futures
+import copy
+import hashlib
+import json
+import math
+import os
+
+import torch
+import torch.multiprocessing
+from torch import nn
+
+from layers import sparse_inputs
+
+# What the sharded evaluation workers read: the model, the dataset and the evaluation settings, set before the fork
+_SHARD_STATE = {}
+
+
+# Online per-datapoint statistics of the log-weights log(p(x,z_k)/q(z_k|x)) streamed in so far.
+# Everything is kept relative to a running max (the "max trick"), so no (B, K) matrix is ever needed.
+class LogWeightAccumulator:
+    def __init__(self, batch_size, device):
+        self.running_max = torch.full((batch_size,), -math.inf, device=device)
+        # SUM(exp(log_w - running_max)) and SUM(exp(log_w - running_max) * log_w)
+        self.running_sum = torch.zeros(batch_size, device=device)
+        self.running_weighted_sum = torch.zeros(batch_size, device=device)
+        self.num_samples = 0
+
+    # Add a chunk of log-weights.
+    def update(self, log_w):
+        new_max = torch.max(self.running_max, log_w.max(1).values)
+        rescale = torch.exp(self.running_max - new_max)
+        ws_matrix = torch.exp(log_w - new_max.unsqueeze(1))
+
+        self.running_sum = self.running_sum * rescale + ws_matrix.sum(1)
+        self.running_weighted_sum = self.running_weighted_sum * rescale + (
+            ws_matrix * log_w
+        ).sum(1)
+        self.running_max = new_max
+        self.num_samples += log_w.shape[1]
+
+    # Per-datapoint IWAE bound log((1/K)*SUM(p(x,z_k)/q(z_k|x))) over the K samples seen so far.
+    def log_mean_exp(self):
+        return (
+            self.running_max + torch.log(self.running_sum) - math.log(self.num_samples)
+        )
+
+    # Per-datapoint SUM(ws_norm * log(p(x,z_k)/q(z_k|x))), the loss the IWAE objective reports.
+    def self_normalized_mean(self):
+        return self.running_weighted_sum / self.running_sum
+
+
+# LogWeightAccumulator that also keeps every log-weight, for statistics that need the individual samples.
+# The (B, K) matrix is tiny next to the activations that produced it (K floats per observation).
+class LogWeightCollector(LogWeightAccumulator):
+    def __init__(self, batch_size, device):
+        super(LogWeightCollector, self).__init__(batch_size, device)
+        self.chunks = []
+
+    def update(self, log_w):
+        super(LogWeightCollector, self).update(log_w)
+        self.chunks.append(log_w)
+
+    # All log-weights seen so far, in sampling order.
+    def log_weight_matrix(self):
+        return torch.cat(self.chunks, 1)
+
+
+# Online per-datapoint Renyi bounds L_alpha for several alphas at once, plus the VR-max and IWAE bounds.
+# L_alpha = 1/(1-alpha) * log((1/K)*SUM([p(x,z_k)/q(z_k|x)]^(1-alpha))) only rescales the log-weights, so every
+# alpha is accumulated from the same samples with its own running max and sum.
+class RenyiBoundAccumulator:
+    def __init__(self, alphas, batch_size, device):
+        alphas = torch.as_tensor(alphas, dtype=torch.get_default_dtype(), device=device)
+        # The last row is alpha = 0, which is the IWAE bound
+        self.scales = (1 - torch.cat([alphas, alphas.new_zeros(1)])).unsqueeze(1)
+
+        self.running_max = torch.full(
+            (self.scales.shape[0], batch_size), -math.inf, device=device
+        )
+        self.running_sum = torch.zeros_like(self.running_max)
+        self.log_w_sum = torch.zeros(batch_size, device=device)
+        self.log_w_max = torch.full((batch_size,), -math.inf, device=device)
+        self.num_samples = 0
+
+    # Add a chunk of log-weights.
+    def update(self, log_w):
+        # (A+1, B, chunk) log([p(x,z_k)/q(z_k|x)]^(1-alpha))
+        scaled = self.scales.unsqueeze(2) * log_w
+        new_max = torch.max(self.running_max, scaled.max(2).values)
+        self.running_sum = self.running_sum * torch.exp(
+            self.running_max - new_max
+        ) + torch.exp(scaled - new_max.unsqueeze(2)).sum(2)
+        self.running_max = new_max
+
+        self.log_w_sum += log_w.sum(1)
+        self.log_w_max = torch.max(self.log_w_max, log_w.max(1).values)
+        self.num_samples += log_w.shape[1]
+
+    def _bounds(self):
+        log_mean = (
+            self.running_max + torch.log(self.running_sum) - math.log(self.num_samples)
+        )
+        # alpha = 1 is the limit of the formula, which is the average log-weight
+        return torch.where(
+            self.scales == 0,
+            (self.log_w_sum / self.num_samples).expand_as(log_mean),
+            log_mean / self.scales,
+        )
+
+    # Per-datapoint L_alpha for every alpha.
+    def renyi_bounds(self):
+        return self._bounds()[:-1]
+
+    # Per-datapoint IWAE bound L_0.
+    def iwae_bound(self):
+        return self._bounds()[-1]
+
+    # Per-datapoint VR-max bound log(MAX_k(p(x,z_k)/q(z_k|x))).
+    def vrmax_bound(self):
+        return self.log_w_max
+
+
+# Pick how many of the K samples of each observation to push through the model at once.
+# The estimate counts every Linear output twice (pre-activation and nonlinearity) plus four temporaries of the
+# widest layer for the likelihood, for each of the batch_size observations, after setting aside the (B, K, #latents)
+# noise that is drawn up front.
+def chunk_size_for_budget(model, batch_size, K, memory_budget):
+    widths = [m.out_features for m in model.modules() if isinstance(m, nn.Linear)]
+    bytes_per_float = torch.finfo(torch.get_default_dtype()).bits // 8
+    bytes_per_sample = bytes_per_float * (2 * sum(widths) + 4 * max(widths))
+
+    noise_floats = sum(noise_dims(model))
+    if counter_based(model):
+        # Counter-based noise is generated chunk by chunk, so it counts towards the samples in flight only
+        bytes_per_sample += bytes_per_float * noise_floats
+        budget_left = memory_budget
+    else:
+        budget_left = memory_budget - bytes_per_float * batch_size * K * noise_floats
+
+    if budget_left < batch_size * bytes_per_sample:
+        raise ValueError(
+            f"a memory budget of {memory_budget} bytes does not fit {batch_size} observations with K={K} samples "
+            f"({max(memory_budget - budget_left, 0)} bytes of up-front noise plus {batch_size * bytes_per_sample} bytes "
+            "per sample in flight); use a smaller batch, a larger budget or counter-based noise"
+        )
+    return int(min(K, budget_left // (batch_size * bytes_per_sample)))
+
+
+# Number of noise dimensions of each stochastic layer of the model.
+# The shapes are probed on a forked CPU generator, so asking does not shift the sampled noise.
+def noise_dims(model):
+    with torch.random.fork_rng(devices=[]):
+        noise = model.sample_noise(
+            1, 1, torch.device("cpu"), index=torch.zeros(1, dtype=torch.long)
+        )
+    return [eps.shape[-1] for eps in noise]
+
+
+# Whether the model currently draws counter-based noise, i.e. whether any sample's noise can be regenerated on demand.
+def counter_based(model):
+    return getattr(model, "counter_based_noise", lambda: False)()
+
+
+# Noise of the K samples of B observations, split into consecutive chunks of chunk_size samples.
+# Counter-based noise is generated when a chunk is asked for, so only one chunk's noise is ever alive. Any other
+# noise is drawn for all K samples in one go, exactly as model.log_weights would draw it, and then sliced.
+# Either way, asking for the same chunk twice gives the same noise.
+def noise_chunks(model, B, K, chunk_size, device, index=None, noise_device=None):
+    noise_device = device if noise_device is None else noise_device
+    starts = range(0, K, chunk_size)
+    if counter_based(model):
+        return [
+            lambda start=start: [
+                eps.to(device)
+                for eps in model.sample_noise(
+                    B,
+                    K,
+                    noise_device,
+                    index=index,
+                    samples=torch.arange(
+                        start, min(start + chunk_size, K), device=noise_device
+                    ),
+                )
+            ]
+            for start in starts
+        ]
+
+    noise = [
+        eps.to(device) for eps in model.sample_noise(B, K, noise_device, index=index)
+    ]
+    return [
+        lambda start=start: [eps[:, start : start + chunk_size] for eps in noise]
+        for start in starts
+    ]
+
+
+# Stream the K importance samples of every observation through the model, chunk_size samples at a time.
+# The noise comes from noise_chunks, so for a fixed seed the statistics match the unchunked evaluation, and with
+# counter-based noise they do not depend on chunk_size or on how the data is batched.
+def evaluate_log_weights(
+    model, data, K, chunk_size, accumulator=None, index=None, noise_device=None
+):
+    B = data.shape[0]
+    chunks = noise_chunks(model, B, K, chunk_size, data.device, index, noise_device)
+
+    if accumulator is None:
+        accumulator = LogWeightAccumulator(B, data.device)
+    with torch.no_grad():
+        for chunk_noise in chunks:
+            log_w, _ = model.log_weights(data, K, noise=chunk_noise())
+            accumulator.update(log_w)
+
+    return accumulator
+
+
+# Online per-datapoint log-weight statistics where every observation may have seen a different number of samples.
+# Like LogWeightAccumulator everything is kept relative to a running max, and the second moment of the weights
+# is tracked as well, which gives the delta-method standard error of the log-mean-exp estimate.
+class SequentialLogWeightAccumulator:
+    def __init__(self, batch_size, device):
+        self.running_max = torch.full((batch_size,), -math.inf, device=device)
+        # SUM(w), SUM(w * log_w) and SUM(w^2) with w = exp(log_w - running_max)
+        self.running_sum = torch.zeros(batch_size, device=device)
+        self.running_weighted_sum = torch.zeros(batch_size, device=device)
+        self.running_square_sum = torch.zeros(batch_size, device=device)
+        self.num_samples = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    # Add a chunk of log-weights for some of the observations.
+    def update(self, log_w, rows):
+        old_max = self.running_max[rows]
+        new_max = torch.max(old_max, log_w.max(1).values)
+        rescale = torch.exp(old_max - new_max)
+        ws_matrix = torch.exp(log_w - new_max.unsqueeze(1))
+
+        self.running_sum[rows] = self.running_sum[rows] * rescale + ws_matrix.sum(1)
+        self.running_weighted_sum[rows] = self.running_weighted_sum[rows] * rescale + (
+            ws_matrix * log_w
+        ).sum(1)
+        self.running_square_sum[rows] = self.running_square_sum[rows] * rescale**2 + (
+            ws_matrix**2
+        ).sum(1)
+        self.running_max[rows] = new_max
+        self.num_samples[rows] += log_w.shape[1]
+
+    # Per-datapoint IWAE bound over the samples each observation has seen, (B,).
+    def log_mean_exp(self):
+        return (
+            self.running_max
+            + torch.log(self.running_sum)
+            - torch.log(self.num_samples.to(self.running_sum.dtype))
+        )
+
+    # Per-datapoint SUM(ws_norm * log(p(x,z_k)/q(z_k|x))), (B,).
+    def self_normalized_mean(self):
+        return self.running_weighted_sum / self.running_sum
+
+    # Delta-method standard error of each observation's log-mean-exp estimate.
+    # Var(log(mean(w))) ~= Var(w) / (n * mean(w)^2). With heavy-tailed weights the sample variance underestimates
+    # this early on, so only trust it after a reasonable number of samples.
+    def log_mean_exp_stderr(self):
+        n = self.num_samples.to(self.running_sum.dtype)
+        relative_variance = n * self.running_square_sum / self.running_sum**2 - 1
+        return torch.sqrt(relative_variance.clamp(min=0) / n)
+
+
+# Grow the number of samples of each observation in rounds until its bound is known to within tolerance.
+# Every round spends about round_samples samples in total on the observations still running: the budget is spread
+# evenly over them, so as observations converge the remaining ones get more samples per round. An observation
+# retires once it has seen at least min_K samples and the standard error of its log-mean-exp estimate is at most
+# tolerance, or once it has seen max_K samples. The running observations always share the same sample count, so
+# each round is one (N, k) block. With counter-based noise the samples are those of evaluate_log_weights with max_K.
+def evaluate_sequential_k(
+    model,
+    data,
+    max_K,
+    round_samples,
+    tolerance,
+    min_K=1,
+    index=None,
+    noise_device=None,
+):
+    B = data.shape[0]
+    noise_device = data.device if noise_device is None else noise_device
+    accumulator = SequentialLogWeightAccumulator(B, data.device)
+    rows = torch.arange(B, device=data.device)
+    num_samples = 0
+    with torch.no_grad():
+        while rows.numel() > 0:
+            N = rows.numel()
+            k = max(1, min(max_K - num_samples, round_samples // N))
+            if counter_based(model):
+                samples = torch.arange(
+                    num_samples, num_samples + k, device=noise_device
+                )
+                noise = model.sample_noise(
+                    N, k, noise_device, index=index[rows], samples=samples
+                )
+            else:
+                noise = model.sample_noise(N, k, noise_device)
+            noise = [eps.to(data.device) for eps in noise]
+            log_w, _ = model.log_weights(data[rows], k, noise=noise)
+            accumulator.update(log_w, rows)
+            num_samples += k
+
+            if num_samples >= max_K:
+                break
+            stderr = accumulator.log_mean_exp_stderr()[rows]
+            # Repack: only the observations that have not converged take part in the next round
+            running = (stderr > tolerance) | (num_samples < min_K)
+            rows = rows[running]
+
+    return accumulator
+
+
+# Sum of values within each segment of a ragged layout.
+def segment_sum(values, segments, num_segments):
+    return torch.zeros(
+        num_segments, dtype=values.dtype, device=values.device
+    ).index_add(0, segments, values)
+
+
+# log(SUM(exp(values))) within each segment of a ragged layout, e.g. the log-weights of observations with different K.
+# The max trick uses each segment's own max, so segments on very different scales stay accurate.
+def segment_logsumexp(values, segments, num_segments):
+    segment_max = torch.full(
+        (num_segments,), -math.inf, dtype=values.dtype, device=values.device
+    ).scatter_reduce(0, segments, values.detach(), "amax")
+    # Keep empty segments at -inf without producing nan from -inf - (-inf)
+    shift = torch.where(
+        torch.isinf(segment_max), torch.zeros_like(segment_max), segment_max
+    )
+    sums = segment_sum(torch.exp(values - shift[segments]), segments, num_segments)
+    return shift + torch.log(sums)
+
+
+# IWAE bounds for every K' in ks from one (B, K) matrix of i.i.d. log-weights.
+# The K samples of each observation are split into floor(K/K') disjoint blocks of K' samples. Each block gives an
+# independent L_K' estimate, so their mean estimates L_K' and their spread is the variance of a single estimate.
+def nested_k_bounds(log_w, ks):
+    bounds = {}
+    for k in ks:
+        num_blocks = log_w.shape[1] // k
+        if num_blocks == 0:
+            raise ValueError(
+                f"K'={k} is larger than the {log_w.shape[1]} samples available"
+            )
+
+        blocks = log_w[:, : num_blocks * k].reshape(log_w.shape[0], num_blocks, k)
+        block_bounds = torch.logsumexp(blocks, 2) - math.log(k)
+        if num_blocks > 1:
+            variance = block_bounds.var(1)
+        else:
+            variance = torch.full_like(block_bounds[:, 0], math.nan)
+        bounds[k] = (block_bounds.mean(1), variance, num_blocks)
+
+    return bounds
+
+
+# Dataset-level L_K' for a nested set of sample sizes, accumulated batch by batch.
+class KTightnessCurve:
+    def __init__(self, ks):
+        self.ks = sorted(ks)
+        self.bound_sums = {k: 0.0 for k in self.ks}
+        self.variance_sums = {k: 0.0 for k in self.ks}
+        self.mean_variance_sums = {k: 0.0 for k in self.ks}
+        # Fewest blocks any batch split its samples into for each K'; with one block there is no spread to measure
+        self.num_blocks = {k: math.inf for k in self.ks}
+        self.num_datapoints = 0
+
+    # Add a batch of log-weights.
+    def add(self, log_w):
+        self.add_bounds(nested_k_bounds(log_w, self.ks), log_w.shape[0])
+
+    # Add the nested_k_bounds of a batch.
+    def add_bounds(self, bounds, num_datapoints):
+        for k in self.ks:
+            bound, variance, num_blocks = bounds[k]
+            self.bound_sums[k] += bound.sum().item()
+            self.num_blocks[k] = min(self.num_blocks[k], num_blocks)
+            if num_blocks > 1:
+                self.variance_sums[k] += variance.sum().item()
+                self.mean_variance_sums[k] += (variance / num_blocks).sum().item()
+        self.num_datapoints += num_datapoints
+
+    # Average bound per K'.
+    def summary(self):
+        summary = {}
+        for k in self.ks:
+            summary[k] = {"bound": self.bound_sums[k] / self.num_datapoints}
+            if self.num_blocks[k] > 1:
+                summary[k]["variance"] = self.variance_sums[k] / self.num_datapoints
+                summary[k]["stderr"] = (
+                    math.sqrt(self.mean_variance_sums[k]) / self.num_datapoints
+                )
+            else:
+                summary[k]["variance"] = summary[k]["stderr"] = None
+        return summary
+
+
+# Observations and, if the loader yields them, dataset indices of a (data, labels[, index]) batch, moved to device.
+def unpack_batch(batch, device):
+    data = batch[0].to(device)
+    index = batch[2].to(device) if len(batch) > 2 else None
+    return data, index
+
+
+# Average Renyi bounds over a dataset for a whole vector of alphas from a single sampling pass.
+def renyi_bound_sweep(model, loader, alphas, K, memory_budget, device):
+    model.eval()
+    renyi, vrmax, iwae, num_datapoints = 0, 0, 0, 0
+    for batch in loader:
+        data, index = unpack_batch(batch, device)
+        B = data.shape[0]
+        accumulator = evaluate_log_weights(
+            model,
+            data,
+            K,
+            chunk_size_for_budget(model, B, K, memory_budget),
+            accumulator=RenyiBoundAccumulator(alphas, B, device),
+            index=index,
+        )
+        renyi = renyi + accumulator.renyi_bounds().sum(1)
+        vrmax = vrmax + accumulator.vrmax_bound().sum()
+        iwae = iwae + accumulator.iwae_bound().sum()
+        num_datapoints += B
+
+    return {
+        "alphas": torch.as_tensor(alphas),
+        "renyi": renyi.cpu() / num_datapoints,
+        "vrmax": vrmax.item() / num_datapoints,
+        "iwae": iwae.item() / num_datapoints,
+    }
+
+
+def _init_shard_worker(num_threads):
+    # Split the cores between the workers instead of letting every worker spin up a thread per core
+    torch.set_num_threads(num_threads)
+
+
+# Per-datapoint bounds of one shard of the dataset, run in a worker process or in the calling process.
+def _evaluate_shard(shard):
+    state = _SHARD_STATE
+    dataset, shard_size, model = state["dataset"], state["shard_size"], state["model"]
+    K, ks, sequential = state["K"], state["ks"], state["sequential"]
+    indices = range(shard * shard_size, min((shard + 1) * shard_size, len(dataset)))
+    device = next(model.parameters()).device
+
+    data = torch.stack([dataset[i][0] for i in indices])
+    # Any CSR form of the shard is built on the CPU, before the data moves to the model's device
+    rows = state["make_rows"](data) if state["make_rows"] is not None else None
+    data = data.to(device)
+    index = torch.tensor(list(indices), device=device)
+    B = data.shape[0]
+    chunk_size = chunk_size_for_budget(model, B, K, state["memory_budget"])
+
+    # The noise comes from the CPU generator seeded with seed + shard, so it neither depends on which process picks the
+    # shard up nor on the device the model runs on; the caller's own RNG state is left alone
+    with torch.random.fork_rng(devices=[]), torch.no_grad(), sparse_inputs(
+        model, data, rows
+    ):
+        torch.manual_seed(state["seed"] + shard)
+        if sequential is not None:
+            tolerance, min_K = sequential
+            # Rounds of the same number of samples, spread over the observations whose bound has not converged yet
+            stats = evaluate_sequential_k(
+                model,
+                data,
+                K,
+                B * chunk_size,
+                tolerance,
+                min_K=min_K,
+                index=index,
+                noise_device=torch.device("cpu"),
+            )
+        else:
+            accumulator_class = LogWeightCollector if ks else LogWeightAccumulator
+            stats = evaluate_log_weights(
+                model,
+                data,
+                K,
+                chunk_size,
+                accumulator=accumulator_class(B, device),
+                index=index,
+                noise_device=torch.device("cpu"),
+            )
+
+        result = {
+            "index": index.cpu(),
+            "log_mean_exp": stats.log_mean_exp().cpu(),
+            "self_normalized_mean": stats.self_normalized_mean().cpu(),
+        }
+        if sequential is not None:
+            result["K"] = stats.num_samples.cpu()
+            result["stderr"] = stats.log_mean_exp_stderr().cpu()
+        if ks:
+            result["nested"] = {
+                k: tuple(v.cpu() if torch.is_tensor(v) else v for v in bounds)
+                for k, bounds in nested_k_bounds(stats.log_weight_matrix(), ks).items()
+            }
+    return result
+
+
+# Evaluate every observation of a dataset with K importance samples, shard by shard.
+# The dataset is cut into fixed shards of shard_size consecutive observations, and shard s draws its noise from the
+# CPU generator after torch.manual_seed(seed + s) (counter-based noise is keyed by the dataset indices anyway). The
+# partition, the seeds and the per-shard memory budget are the same for any num_workers, so the result does not
+# depend on it. With one worker the shards run in the calling process on the model's device; with more, the workers
+# are forked from the calling process and evaluate a CPU copy of the model, so the weights are shared copy-on-write
+# and never pickled, and each worker gets its share of the cores.
+def evaluate_sharded(
+    model,
+    dataset,
+    K,
+    memory_budget,
+    num_workers,
+    shard_size,
+    seed=0,
+    ks=None,
+    sequential=None,
+    make_rows=None,
+):
+    if ks and sequential is not None:
+        raise ValueError("the nested-K curve needs all K samples of every observation")
+    _SHARD_STATE.update(
+        model=model if num_workers == 1 else copy.deepcopy(model).cpu(),
+        dataset=dataset,
+        K=K,
+        memory_budget=memory_budget,
+        shard_size=shard_size,
+        seed=seed,
+        ks=sorted(ks) if ks else None,
+        sequential=sequential,
+        make_rows=make_rows,
+    )
+    num_shards = (len(dataset) + shard_size - 1) // shard_size
+    try:
+        if num_workers == 1:
+            results = [_evaluate_shard(shard) for shard in range(num_shards)]
+        else:
+            context = torch.multiprocessing.get_context("fork")
+            with context.Pool(
+                num_workers,
+                initializer=_init_shard_worker,
+                initargs=(max(1, torch.get_num_threads() // num_workers),),
+            ) as pool:
+                # imap hands back the shards in order, so the reduction below is the same for any number of workers
+                results = list(pool.imap(_evaluate_shard, range(num_shards)))
+    finally:
+        _SHARD_STATE.clear()
+
+    names = ["log_mean_exp", "self_normalized_mean"]
+    if sequential is not None:
+        names += ["K", "stderr"]
+    summary = {name: torch.cat([result[name] for result in results]) for name in names}
+    if ks:
+        curve = KTightnessCurve(ks)
+        for result in results:
+            curve.add_bounds(result["nested"], result["index"].shape[0])
+        summary["curve"] = curve
+    return summary
+
+
+# Detached CPU copy of the model's state_dict, which later optimizer steps leave untouched.
+def weight_snapshot(model):
+    return {
+        name: tensor.detach().to("cpu", copy=True)
+        for name, tensor in model.state_dict().items()
+    }
+
+
+# Runs evaluations on weight snapshots in a separate process while training carries on.
+# The process is spawned, not forked, so it never inherits the trainer's CUDA context; initializer runs there
+# once to build whatever the evaluations need (model, data) and gets num_threads as its last argument to set the
+# process's own thread budget. Snapshots are handed over through shared memory and evaluated in submission order.
+# Up to max_pending snapshots queue up behind a slow evaluation; once that many are in flight, submit waits for the
+# oldest to finish, so every snapshot is evaluated while the memory they hold stays bounded.
+class BackgroundEvaluator:
+    def __init__(self, initializer, initargs=(), num_threads=1, max_pending=1):
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=torch.multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=tuple(initargs) + (num_threads,),
+        )
+        self.max_pending = max_pending
+        self.pending = []
+
+    # Evaluate a snapshot of the model's current weights as fn(epoch, state_dict) in the evaluation process.
+    # When max_pending evaluations are in flight, this first waits for the oldest of them to finish.
+    def submit(self, fn, epoch, model):
+        finished = []
+        while len(self.pending) >= self.max_pending:
+            pending_epoch, future = self.pending.pop(0)
+            finished.append((pending_epoch, future.result()))
+        self.pending.append(
+            (epoch, self.executor.submit(fn, epoch, weight_snapshot(model)))
+        )
+        return finished
+
+    # Collect the results of the evaluations that have finished, re-raising their errors.
+    def poll(self, wait=False):
+        finished = []
+        while self.pending and (wait or self.pending[0][1].done()):
+            epoch, future = self.pending.pop(0)
+            finished.append((epoch, future.result()))
+        return finished
+
+    # Wait for the outstanding evaluations and shut the evaluation process down.
+    def close(self):
+        finished = self.poll(wait=True)
+        self.executor.shutdown()
+        return finished
+
+
+# On-disk store of evaluation results, addressed by the content of the weights and the evaluation spec.
+# Any change to a weight, a parameter name or shape, or an entry of the spec gives a different key, so stale
+# results are never read back; they are simply no longer addressed.
+class EvaluationCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    # Hash of the model's state_dict and the evaluation spec.
+    def key(self, model, spec):
+        digest = hashlib.sha256()
+        for name, tensor in sorted(model.state_dict().items()):
+            digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            digest.update(
+                tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()
+            )
+        digest.update(json.dumps(spec, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.pt")
+
+    # Cached result stored under key, or None.
+    def load(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        return torch.load(self.path(key))
+
+    # Store result under key; written to a temporary file first so readers never see a partial result.
+    def store(self, key, result):
+        temporary = f"{self.path(key)}.{os.getpid()}.tmp"
+        torch.save(result, temporary)
+        os.replace(temporary, self.path(key))
+
+    # Load the result of evaluating model under spec, computing and storing it first if it is not cached.
+    def get_or_compute(self, model, spec, compute):
+        key = self.key(model, spec)
+        result = self.load(key)
+        if result is not None:
+            return result, True
+        result = compute()
+        self.store(key, result)
+        return result, False
+
+
+# Sigmoid annealing schedule from 0 to 1, which spends more of the steps near both ends of the path.
+def ais_schedule(num_steps, delta=4.0):
+    betas = torch.sigmoid(torch.linspace(-delta, delta, num_steps + 1))
+    return (betas - betas[0]) / (betas[-1] - betas[0])
+
+
+def _log_weights_and_grad(model, data, eps, dims):
+    # log(p(x,z)/q(z|x)) of the samples z the model builds from the noise eps, and its gradient with respect to eps
+    with torch.enable_grad():
+        eps = eps.detach().requires_grad_()
+        log_w, _ = model.log_weights(
+            data, eps.shape[1], noise=list(torch.split(eps, dims, 2))
+        )
+        (grad,) = torch.autograd.grad(log_w.sum(), eps)
+    return log_w.detach(), grad
+
+
+# Log AIS weights of num_chains chains per observation, all run together as one (B, num_chains) batch.
+# The chains anneal in the space of the model's reparametrization noise eps ~ N(0, I), which the encoder maps to
+# z ~ q(z|x). The intermediate distributions are f_b(eps) = N(eps; 0, I) * (p(x,z)/q(z|x))^b: b = 0 is the encoder
+# itself and b = 1 integrates to p(x), because p(x,z)/q(z|x) * N(eps; 0, I) is p(x,z) written in eps. The chains
+# move with HMC, and each chain tunes its own step size towards target_acceptance.
+def ais_log_weights(
+    model,
+    data,
+    num_chains,
+    betas,
+    leapfrog_steps=10,
+    step_size=0.05,
+    target_acceptance=0.65,
+):
+    dims = noise_dims(model)
+    B = data.shape[0]
+    eps = torch.randn(B, num_chains, sum(dims), device=data.device)
+    log_w, grad = _log_weights_and_grad(model, data, eps, dims)
+    log_ais_w = torch.zeros(B, num_chains, device=data.device)
+    step = torch.full((B, num_chains, 1), step_size, device=data.device)
+
+    for beta_prev, beta in zip(betas[:-1].tolist(), betas[1:].tolist()):
+        # Weight update of moving from f_beta_prev to f_beta at the current state
+        log_ais_w += (beta - beta_prev) * log_w
+
+        # One HMC transition that leaves f_beta invariant; the gradient of log f_beta is beta * grad - eps
+        momentum = torch.randn_like(eps)
+        new_eps = eps
+        new_momentum = momentum + 0.5 * step * (beta * grad - eps)
+        for leapfrog in range(leapfrog_steps):
+            new_eps = new_eps + step * new_momentum
+            new_log_w, new_grad = _log_weights_and_grad(model, data, new_eps, dims)
+            scale = 1.0 if leapfrog < leapfrog_steps - 1 else 0.5
+            new_momentum = new_momentum + scale * step * (beta * new_grad - new_eps)
+
+        energy = -beta * log_w + 0.5 * torch.sum(eps**2 + momentum**2, 2)
+        new_energy = -beta * new_log_w + 0.5 * torch.sum(
+            new_eps**2 + new_momentum**2, 2
+        )
+        # A NaN proposal compares False and is rejected
+        accept = torch.log(torch.rand_like(energy)) < energy - new_energy
+        eps = torch.where(accept.unsqueeze(2), new_eps, eps)
+        log_w = torch.where(accept, new_log_w, log_w)
+        grad = torch.where(accept.unsqueeze(2), new_grad, grad)
+
+        # Grow the step size of chains that accepted and shrink it for the others, so acceptance settles near the target
+        factor = torch.full_like(
+            log_w, 1.02 ** (-target_acceptance / (1 - target_acceptance))
+        )
+        factor[accept] = 1.02
+        step = step * factor.unsqueeze(2)
+
+    return log_ais_w
+
+
+# AIS estimate of log p(x) for a batch of observations, with the chains split into chunks that fit the budget.
+def annealed_importance_sampling(
+    model,
+    data,
+    num_chains,
+    num_steps,
+    memory_budget,
+    leapfrog_steps=10,
+    step_size=0.05,
+):
+    B = data.shape[0]
+    # The gradient of every HMC step keeps the forward activations alive, so count each chain three times
+    chunk_size = chunk_size_for_budget(model, B, num_chains, memory_budget // 3)
+    betas = ais_schedule(num_steps)
+    accumulator = LogWeightAccumulator(B, data.device)
+    for start in range(0, num_chains, chunk_size):
+        accumulator.update(
+            ais_log_weights(
+                model,
+                data,
+                min(chunk_size, num_chains - start),
+                betas,
+                leapfrog_steps=leapfrog_steps,
+                step_size=step_size,
+            )
+        )
+    return accumulator
@@ -1,16 +1,29 @@
 import datetime
 import logging
+import logging.handlers
 import os
 
-import numpy as np
 import torch
 import torch.utils.data
-from torch import nn, optim, Tensor as T
-from torch.autograd import detect_anomaly
-from torch.distributions.multinomial import Multinomial
+from torch import nn, optim
+from torch.nn import functional as F
 from torchvision import datasets, transforms
 from torchvision.utils import save_image
 
+from distributions import gaussian_log_prob, standard_normal_log_prob
+from evaluation import (
+    BackgroundEvaluator,
+    EvaluationCache,
+    annealed_importance_sampling,
+    chunk_size_for_budget,
+    evaluate_log_weights,
+    evaluate_sharded,
+    renyi_bound_sweep,
+)
+from layers import SparseInputLinear, binary_rows, sparse_inputs
+from noise import NOISE_SOURCES, CounterNoise, sample_normal_noise
+from objectives import make_objective
+
 os.makedirs("results", exist_ok=True)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -20,6 +33,27 @@ alpha = (
 )  # alpha value used in Renyi alpha-divergence, ignored when model_type is vae/iwae/vrmax
 K = 5  # number of samples taken per input data point
 L = 2  # number of stochastic layers in network architecture; either 1 or 2
+encode_once = True  # encode each input once and draw its K samples from the shared q(z|x); False replicates every input K times before encoding
+sparse_backprop = True  # vrmax/vralpha only: score all K samples without gradients, then rebuild the graph for the selected sample of each input
+k_chunk_size = None  # iwae/general_alpha only: backpropagate the K samples in chunks of this size to bound memory, None processes all K at once
+fused_eval_likelihood = True  # without gradients, reduce decoder logits straight into log p(x|z) pixel block by pixel block instead of materializing the reconstruction
+eval_pixel_block = 112  # number of pixels whose logits are alive at once in the fused evaluation likelihood
+dreg = False  # iwae/general_alpha only: train the encoder with the doubly reparameterized gradient estimator (DReG)
+truncate_mass = None  # iwae/general_alpha only: backpropagate only the highest-weighted samples of each input that together hold this share of ws_norm (e.g. 0.99)
+truncate_top_k = None  # iwae/general_alpha only: backpropagate only this many highest-weighted samples of each input; exclusive with truncate_mass
+adaptive_k = False  # iwae/general_alpha only: spread the B*K samples of a batch over its inputs in proportion to their tracked log-weight variance
+adaptive_min_k = 2  # fewest samples an input gets with adaptive_k
+analytic_kl = False  # vae with L=1 only: use the closed-form KL(q(z|x) || p(z)) and spend the K samples on the reconstruction term alone
+train_noise = "iid"  # noise source of the importance samples during training; one of ['iid', 'antithetic', 'sobol', 'counter']
+# 'counter' keys the noise by (seed, step, dataset index, sample index, layer), so chunked and sparse passes regenerate it instead of storing it
+test_noise = "iid"  # noise source of the importance samples during testing; 'sobol' tightens the test_K estimate most when test_K is a power of 2
+sparse_first_layer = False  # binarized data only: feed the first encoder layer only the nonzero pixels of each input (CSR, built in the data loader) and sum their weight columns instead of the dense 784-wide matmul; the loaders below yield grayscale pixels, which gain nothing from it
+mixed_precision = False  # run the Linear/tanh layers under bf16 autocast; log-densities, likelihood sums and log-weights stay in fp32
+# with mixed_precision, report the test NLL drift against fp32 after training
+mixed_precision_parity_check = True
+weight_telemetry = False  # log the effective sample size 1/SUM(ws_norm^2), max normalized weight and log-weight variance of the training batches each epoch
+compile_objective = False  # run the model forward pass and objective through torch.compile (TorchScript for the objective alone on older PyTorch)
+detect_anomalies = False  # run autograd anomaly detection during backward; slow, only needed when hunting down NaNs
 
 # VAE, IWAE, VR-max and VR-alpha are described in the paper
 # general_alpha is the same as VR-alpha except that we backpropagate K samples instead of only one
@@ -32,10 +66,31 @@ learning_rate = 1e-3
 log_interval = 1  # how frequently to log average training loss
 test_interval = 1  # how frequently to test
 train_batch_size = 100  # batch size during training
-test_batch_size = 32  # batch size used during testing, different than training because testing is done with K=5000
+test_batch_size = 100  # batch size used during testing; the test_K samples of a batch are streamed in chunks that fit test_memory_budget
+test_K = 5000  # number of importance samples per test data point
+# bytes the evaluation of one test batch may hold at once (per worker with test_workers), sets the chunk size over the test_K samples
+test_memory_budget = 2**30
+# also report the test NLL at each of these K' < test_K, from the same test_K samples; K' = test_K gets no error bar
+test_nested_K = [1, 5, 50, 500]
+test_renyi_alphas = None  # also report the test L_alpha for each of these alphas (e.g. [-1, 0, 0.5, 1]) and the VR-max bound, from one more pass of test_K samples; None skips it
+background_test = False  # run the periodic tests on CPU in a separate process on a snapshot of the weights, so training does not wait for them; they log tagged by their epoch when done
+# CPU threads the background test process may use; training keeps the rest
+background_test_threads = 4
+# bytes of weight snapshots that may queue up behind a running background test; once they are used up, training waits for the oldest test at the next test point
+background_test_memory = 2**28
+test_sequential_K = False  # give each test observation samples in rounds until the standard error of its bound drops below test_stderr_tolerance, up to test_K
+test_stderr_tolerance = 0.01  # delta-method standard error of a test observation's log-mean-exp at which test_sequential_K stops sampling it
+test_min_K = 100  # fewest samples a test observation gets with test_sequential_K; the standard error is unreliable before that
+ais_chains = 0  # after training, also estimate the test log p(x) by annealed importance sampling from q(z|x) with this many HMC chains per observation; 0 skips it
+ais_steps = 1000  # number of intermediate distributions between q(z|x) and p(x,z)
+ais_leapfrog_steps = 10  # leapfrog steps of each HMC transition
+test_cache_dir = "results/eval_cache"  # keep the per-datapoint test bounds of the final weights keyed by a hash of the weights and the test settings, so re-testing them loads the bounds; None disables
+test_workers = 1  # evaluate the test set in this many CPU worker processes, test_batch_size observations per shard; the result does not depend on the number of workers
 
 seed = 1  # fixed seed
 torch.manual_seed(seed)
+# noise of the 'counter' source; train() advances its step, _test() evaluates at step 0
+counter_noise = CounterNoise(seed)
 
 assert L in [1, 2]  # we only have networks with 1 or 2 stochastic layers
 assert model_type in ["vae", "iwae", "vrmax", "vralpha", "general_alpha"]
@@ -43,13 +98,110 @@ assert not (
     alpha == 1 and model_type in ["vralpha", "general_alpha"]
 )  # divide by 0 error otherwise
 assert data_name in ["mnist", "fashion", "fashionmnist"]
+assert train_noise in list(NOISE_SOURCES) + ["counter"]
+assert test_noise in list(NOISE_SOURCES) + ["counter"]
+assert truncate_mass is None or truncate_top_k is None
+assert not (
+    analytic_kl and L != 1
+)  # the closed-form KL needs q(z|x) and p(z) to be diagonal Gaussians
+assert not (
+    test_sequential_K and test_nested_K
+)  # the nested-K curve needs all test_K samples of every observation
+assert not (
+    adaptive_k and train_noise in ["antithetic", "sobol"]
+)  # adaptive_k draws one sample per row, which turns correlated noise into iid noise
+
+
+# What the models below share: the settings of how they compute their log-weights, fixed when a model is built so that
+# no method reads the hyperparameters above while it runs (a compiled loss keys on them instead, see key)
+class LatentVariableModel(nn.Module):
+    def __init__(
+        self,
+        alpha,
+        encode_once=encode_once,
+        fused_eval_likelihood=fused_eval_likelihood,
+        eval_pixel_block=eval_pixel_block,
+        mixed_precision=mixed_precision,
+        train_noise=train_noise,
+        test_noise=test_noise,
+        counter_noise=counter_noise,
+    ):
+        super(LatentVariableModel, self).__init__()
+        self.K = K
+        self.alpha = alpha
+        self.encode_once = encode_once
+        self.fused_eval_likelihood = fused_eval_likelihood
+        self.eval_pixel_block = eval_pixel_block
+        self.mixed_precision = mixed_precision
+        self.train_noise = train_noise
+        self.test_noise = test_noise
+        self.counter_noise = counter_noise
+
+    def key(self):
+        # Everything besides the weights that the computation of the log-weights depends on
+        return (
+            type(self).__name__,
+            self.encode_once,
+            self.fused_eval_likelihood,
+            self.eval_pixel_block,
+            self.mixed_precision,
+            self.train_noise,
+            self.test_noise,
+        )
 
+    def latent_dims(self):
+        raise NotImplementedError
+
+    def noise_source(self):
+        # Noise source of the current mode (train/eval)
+        return self.train_noise if self.training else self.test_noise
+
+    def counter_based_noise(self):
+        # Whether the importance samples come from counter_noise, so any sample can be regenerated on demand
+        return self.noise_source() == "counter"
+
+    def sample_noise(self, B, K, device, index=None, samples=None):
+        # One (B, K, #latents) standard normal draw per stochastic layer, in the order the layers consume them
+        return draw_noise(
+            self.noise_source(),
+            B,
+            K,
+            self.latent_dims(),
+            device,
+            self.counter_noise,
+            index,
+            samples,
+        )
 
-class mnist_omniglot_model1(nn.Module):
-    def __init__(self, alpha):
-        super(mnist_omniglot_model1, self).__init__()
+    def layer_autocast(self, device):
+        # Context the Linear/tanh layers run in on device: bf16 autocast when mixed_precision is set, a no-op otherwise.
+        # Whatever leaves the layers for a log-density is cast back to fp32 first, so log_w and everything summed from it stay fp32
+        return torch.autocast(
+            device.type, dtype=torch.bfloat16, enabled=self.mixed_precision
+        )
+
+    def bernoulli_log_likelihood(self, hidden, output_layer, x):
+        # log p(x|hidden) with the logits output_layer(hidden); x = (B, 1, H*W) broadcasts against the (B, K, H*W) logits.
+        # Evaluation only needs log p(x|z), so it never builds the full reconstruction. Training keeps the logits kernel
+        # even in its no-grad scoring passes, so that they reproduce the log-weights of the passes with autograd exactly
+        if (
+            self.fused_eval_likelihood
+            and not self.training
+            and not torch.is_grad_enabled()
+        ):
+            return compute_log_probabitility_bernoulli_blocked(
+                hidden, output_layer, x, self.eval_pixel_block
+            )
+        return compute_log_probabitility_bernoulli_logits(
+            output_layer(hidden), x, axis=2
+        )
 
-        self.fc1 = nn.Linear(784, 200)
+
+class mnist_omniglot_model1(LatentVariableModel):
+    def __init__(self, alpha, **settings):
+        super(mnist_omniglot_model1, self).__init__(alpha, **settings)
+
+        self.fc1 = SparseInputLinear(784, 200)
         self.fc2 = nn.Linear(200, 200)
         self.fc31 = nn.Linear(200, 50)
         self.fc32 = nn.Linear(200, 50)
@@ -58,125 +210,135 @@ class mnist_omniglot_model1(nn.Module):
         self.fc5 = nn.Linear(200, 200)
         self.fc6 = nn.Linear(200, 784)
 
-        self.K = K
-        self.alpha = alpha
-
     def encode(self, x):
         h1 = torch.tanh(self.fc1(x))
         h2 = torch.tanh(self.fc2(h1))
         return self.fc31(h2), self.fc32(h2)
 
-    def reparameterize(self, mu, logstd):
+    def reparameterize(self, mu, logstd, eps=None):
         std = torch.exp(logstd)
-        eps = torch.randn_like(std)
+        if eps is None:
+            eps = torch.randn_like(std)
         # This is the reparametrization trick - represent the sample as a sum rather than black-box generated number
         return mu + eps * std
 
-    def decode(self, z):
+    def decode_hidden(self, z):
         h3 = torch.tanh(self.fc4(z))
-        h4 = torch.tanh(self.fc5(h3))
-        return torch.sigmoid(self.fc6(h4))
+        return torch.tanh(self.fc5(h3))
+
+    def decode_logits(self, z):
+        return self.fc6(self.decode_hidden(z))
+
+    def decode(self, z):
+        # The sigmoid is only needed to render images; the likelihoods work on the logits
+        return torch.sigmoid(self.decode_logits(z))
 
     def forward(self, x):
         mu, logstd = self.encode(x.view(-1, 784))
         z = self.reparameterize(mu, logstd)
         return self.decode(z), mu, logstd
 
-    def compute_loss_for_batch(self, data, model, K=K, test=False):
-        # data = (B, 1, H, W)
+    def latent_dims(self):
+        return [self.fc31.out_features]
+
+    def log_weights(self, data, K, noise=None, dreg_scale=None, rows=None, index=None):
+        # data = (B, 1, H, W), with dataset indices index = (B,) that key counter-based noise
+        # dreg_scale maps the detached (B, K) log-weights to the factor each sample's encoder gradient is rescaled by (see objectives.dreg_grad_scale)
+        # rows = (N,) gives observations different numbers of samples: sample n belongs to observation rows[n], the noise is
+        # (N, 1, #latents) and the log-weights come back as (N, 1)
         B, _, H, W = data.shape
 
-        # Generate K copies of each observation. Each will get sampled once according to the generated distribution to generate a total of K observation samples
-        data_k_vec = data.repeat((1, K, 1, 1)).view(-1, H * W)
+        # Draw K fresh samples per observation, or replay the samples of previously drawn noise (then K is read off the noise)
+        if noise is None:
+            noise = self.sample_noise(B, K, data.device, index=index)
+        [eps] = noise
+        K = eps.shape[1]
+
+        # Give each observation its own sample axis: x = (B, 1, H*W)
+        x = data.view(B, 1, H * W)
 
         # Retrieve the estimated mean and log(standard deviation) estimates from the posterior approximator
-        mu, logstd = model.encode(data_k_vec)
+        with self.layer_autocast(data.device):
+            if self.encode_once:
+                # The encoder is deterministic, so the K samples of an observation all share one mu and log(standard deviation).
+                # Encode the B unique observations once; mu, logstd = (B, 1, #latents) broadcast against the K samples below
+                mu, logstd = self.encode(x)
+            else:
+                # Generate K copies of each observation and encode every copy; mu, logstd = (B, K, #latents)
+                mu, logstd = self.encode(x.repeat((1, K, 1)))
+        mu, logstd = mu.float(), logstd.float()
+
+        if rows is not None:
+            # Every sample becomes a row of its own that shares its observation's encoding
+            x, mu, logstd = x[rows], mu[rows], logstd[rows]
 
         # Use the reparametrization trick to generate (mean)+(epsilon)*(standard deviation) for each sample of each observation
-        z = model.reparameterize(mu, logstd)
+        z = self.reparameterize(mu, logstd, eps)
 
         # Calculate log q(z|x) - how likely are the importance samples given the distribution that generated them?
-        log_q = compute_log_probabitility_gaussian(z, mu, logstd)
+        if dreg_scale is None:
+            log_q = gaussian_log_prob(z, mu, logstd, axis=2)
+        else:
+            # DReG drops the score function term: the encoder's gradient may only reach log q(z|x) through the samples z
+            log_q = gaussian_log_prob(z, mu.detach(), logstd.detach(), axis=2)
 
         # Calculate log p(z) - how likely are the importance samples under the prior N(0,1) assumption?
-        log_p_z = compute_log_probabitility_gaussian(
-            z,
-            torch.zeros_like(z, requires_grad=False),
-            torch.zeros_like(z, requires_grad=False),
-        )
+        log_p_z = standard_normal_log_prob(z, axis=2)
 
-        # Hand the samples to the decoder network and get a reconstruction of each sample.
-        decoded = model.decode(z)
+        with self.layer_autocast(data.device):
+            # Hand the samples to the decoder network. Only the decoder sees all B*K rows
+            hidden = self.decode_hidden(z)
 
-        # Calculate log p(x|z) with a bernoulli distribution - how likely are the recreations given the latents that generated them?
-        log_p = compute_log_probabitility_bernoulli(decoded, data_k_vec)
+            # Calculate log p(x|z) with a bernoulli distribution - how likely are the recreations given the latents that generated them?
+            # x = (B, 1, H*W) broadcasts against the (B, K, H*W) reconstruction, so the observations are never copied K times
+            log_p = self.bernoulli_log_likelihood(hidden, self.fc6, x)
 
-        # Begin calculating L_alpha depending on the (a) model type, and (b) optimization method
         # log_p_z + log_p - log_q = log(p(z_i)p(x|z_i)/q(z_i|x)) = log(p(x,z_i)/q(z_i|x)) = L_VI
-        #   (for each importance sample i out of K for each observation)
-        if model_type == "iwae" or test:
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            log_w_matrix = (log_p_z + log_p - log_q).view(B, K)
-
-        elif model_type == "vae":
-            # Don't reorder, and divide by K in anticipation of taking a batch sum of (1/K)*SUM(log(p(x,z)/q(z|x)))
-            log_w_matrix = (log_p_z + log_p - log_q).view(B * K, 1) * 1 / K
-
-        elif model_type == "general_alpha" or model_type == "vralpha":
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            # Multiply by (1-alpha) because (1-alpha)* log(p(x,z_i)/q(z_i|x)) =  log([p(x,z_i)/q(z_i|x)]^(1-alpha))
-            log_w_matrix = (log_p_z + log_p - log_q).view(-1, K) * (1 - alpha)
-
-        elif model_type == "vrmax":
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            # Take the max in each row, representing the maximum-weighted sample
-            log_w_matrix = (
-                (log_p_z + log_p - log_q).view(-1, K).max(axis=1, keepdim=True).values
-            )
+        #   (for each importance sample i out of K for each observation, so each row holds the K importance samples of one observation)
+        log_w = log_p_z + log_p - log_q
 
-            # immediately return loss = -sum(L_alpha) over each observation
-            return -torch.sum(log_w_matrix)
+        if dreg_scale is not None:
+            # Only the encoder's gradient flows back through z, so rescaling it per sample leaves the decoder's gradient alone
+            z_grad_scale = dreg_scale(log_w.detach()).unsqueeze(2)
+            z.register_hook(lambda grad: grad * z_grad_scale)
 
-        # Begin using the "max trick". Subtract the maximum log(*) sample value for each observation.
-        # log_w_minus_max = log([p(z_i,x)/q(z_i|x)] / max([p(z_k,x)/q(z_k|x)]))
-        log_w_minus_max = log_w_matrix - torch.max(log_w_matrix, 1, keepdim=True)[0]
+        return log_w, noise
 
-        # Exponentiate so that each term is [p(z_i,x)/q(z_i|x)] / max([p(z_k,x)/q(z_k|x)]) (no log)
-        ws_matrix = torch.exp(log_w_minus_max)
+    def elbo_analytic_kl(self, data, K, noise=None, index=None):
+        # ELBO = E_q[log p(x|z)] - KL(q(z|x) || p(z)) for each observation (B,), with the KL term in closed form
+        # so that the K samples only estimate the reconstruction term
+        B, _, H, W = data.shape
 
-        # Calculate normalized weights in each row. Max denominators cancel out!
-        # ws_norm = [p(z_i,x)/q(z_i|x)]/SUM([p(z_k,x)/q(z_k|x)])
-        ws_norm = ws_matrix / torch.sum(ws_matrix, 1, keepdim=True)
+        if noise is None:
+            noise = self.sample_noise(B, K, data.device, index=index)
+        [eps] = noise
 
-        if model_type == "vralpha" and not test:
-            # If we're specifically using a VR-alpha model, we want to choose a sample to backprop according to the values in ws_norm above
-            # So we make a distribution in each row
-            sample_dist = Multinomial(1, ws_norm)
+        x = data.view(B, 1, H * W)
 
-            # Then we choose a sample in each row acccording to this distribution
-            ws_sum_per_datapoint = log_w_matrix.gather(
-                1, sample_dist.sample().argmax(1, keepdim=True)
-            )
-        else:
-            # For any other model, we're taking the full sum at this point
-            ws_sum_per_datapoint = torch.sum(log_w_matrix * ws_norm, 1)
+        # q(z|x) is the same for all K samples of an observation, so it is always encoded once here; mu, logstd = (B, 1, #latents)
+        with self.layer_autocast(data.device):
+            mu, logstd = self.encode(x)
+        mu, logstd = mu.float(), logstd.float()
+        z = self.reparameterize(mu, logstd, eps)
+
+        # KL(N(mu, std^2) || N(0, 1)) = 0.5*(mu^2 + std^2 - 1) - log(std), summed over the latents once per observation
+        kl = torch.sum(0.5 * (mu**2 + torch.exp(2 * logstd) - 1) - logstd, 2).view(B)
 
-        if model_type in ["general_alpha", "vralpha"] and not test:
-            # For both VR-alpha and directly estimating L_alpha with a sum, we have to renormalize the sum with 1-alpha
-            ws_sum_per_datapoint /= 1 - alpha
+        with self.layer_autocast(data.device):
+            log_p = self.bernoulli_log_likelihood(self.decode_hidden(z), self.fc6, x)
 
-        # Return a value of loss = -L_alpha as the batch sum.
-        loss = -torch.sum(ws_sum_per_datapoint)
+        return torch.mean(log_p, 1) - kl
 
-        return loss
+    def compute_loss_for_batch(self, data, objective):
+        return objective(self, data)
 
 
 # Define the model
-class mnist_omniglot_model2(nn.Module):
-    def __init__(self, alpha):
-        super(mnist_omniglot_model2, self).__init__()
+class mnist_omniglot_model2(LatentVariableModel):
+    def __init__(self, alpha, **settings):
+        super(mnist_omniglot_model2, self).__init__(alpha, **settings)
 
-        self.fc1 = nn.Linear(784, 200)
+        self.fc1 = SparseInputLinear(784, 200)
         self.fc2 = nn.Linear(200, 200)
         self.fc31 = nn.Linear(200, 100)  # stochastic 1
         self.fc32 = nn.Linear(200, 100)
@@ -195,190 +357,220 @@ class mnist_omniglot_model2(nn.Module):
         self.fc10 = nn.Linear(200, 200)
         self.fc11 = nn.Linear(200, 784)  # reconstruction
 
-        self.K = K
-        self.alpha = alpha
+    def encode(self, x, eps=None):
+        mu, log_std = self.encode_h1(x)
 
-    def encode(self, x):
+        z1 = self.reparameterize(mu, log_std, eps=eps)
+        mu_z, log_std_z = self.encode_z(z1)
+
+        # Return the parameters of q(z|h1) along with the parameters of q(h1|x) and the first-layer latents z1 sampled from it
+        return mu_z, log_std_z, [mu, log_std, z1]
+
+    def encode_h1(self, x):
+        # Parameters of q(h1|x), the deterministic part of the encoder
         h1 = torch.tanh(self.fc1(x))
         h2 = torch.tanh(self.fc2(h1))
-        mu, log_std = self.fc31(h2), self.fc32(h2)
+        return self.fc31(h2), self.fc32(h2)
 
-        z1 = self.reparameterize(mu, log_std)
-        h3 = torch.tanh(self.fc4(z1))
-        h4 = torch.tanh(self.fc5(h3))
+    def encode_z(self, z1, detach_params=False):
+        # Parameters of q(z|h1). With detach_params the weights are cut off from autograd, so gradients only flow through z1
+        def linear(layer, h):
+            if detach_params:
+                return F.linear(h, layer.weight.detach(), layer.bias.detach())
+            return layer(h)
 
-        return self.fc61(h4), self.fc62(h4), [x, z1]
+        h3 = torch.tanh(linear(self.fc4, z1))
+        h4 = torch.tanh(linear(self.fc5, h3))
+        return linear(self.fc61, h4), linear(self.fc62, h4)
 
-    def reparameterize(self, mu, logstd, test=False):
+    def reparameterize(self, mu, logstd, test=False, eps=None):
         std = torch.exp(logstd)
         if test == True:
             eps = torch.zeros_like(mu)
-        else:
+        elif eps is None:
             eps = torch.randn_like(std)
         # This is the reparametrization trick - represent the sample as a sum rather than black-box generated number
         return mu + eps * std
 
-    def decode(self, z, test=False):
+    def decode_layers(self, z, z1=None, test=False):
+        # Run the decoder up to its last hidden layer; fc11 turns that into the reconstruction
         h5 = torch.tanh(self.fc7(z))
         h6 = torch.tanh(self.fc8(h5))
         mu, log_std = self.fc81(h6), self.fc82(h6)
 
-        z1 = self.reparameterize(mu, log_std, test=test)
+        # Sample the first-layer latents from p(h1|z) unless the encoder already provided them
+        if z1 is None:
+            z1 = self.reparameterize(mu, log_std, test=test)
         h7 = torch.tanh(self.fc9(z1))
-        h8 = torch.tanh(self.fc10(h7))
 
-        return torch.sigmoid(self.fc11(h8))
+        # Return the last hidden layer along with the parameters of p(h1|z) and the first-layer latents that were decoded
+        return torch.tanh(self.fc10(h7)), [mu, log_std, z1]
+
+    def decode_logits(self, z, test=False):
+        return self.fc11(self.decode_layers(z, test=test)[0])
+
+    def decode(self, z, test=False):
+        # The sigmoid is only needed to render images; the likelihoods work on the logits
+        return torch.sigmoid(self.decode_logits(z, test=test))
 
     def forward(self, x):
         mu, logstd, _ = self.encode(x.view(-1, 784))
         z = self.reparameterize(mu, logstd)
         return self.decode(z), mu, logstd
 
-    def compute_loss_for_batch(self, data, model, K=K, test=False):
+    def latent_dims(self):
+        return [self.fc31.out_features, self.fc61.out_features]
+
+    def log_weights(self, data, K, noise=None, dreg_scale=None, rows=None, index=None):
+        # index = (B,) holds the dataset indices of data that key counter-based noise
+        # dreg_scale maps the detached (B, K) log-weights to the factor each sample's encoder gradient is rescaled by (see objectives.dreg_grad_scale)
+        # rows = (N,) gives observations different numbers of samples: sample n belongs to observation rows[n], the noise is
+        # (N, 1, #latents) each and the log-weights come back as (N, 1)
         B, _, H, W = data.shape
 
-        # First repeat the observations K times, representing the data as a flat (M*K, # of pixels)
-        data_k_vec = data.repeat((1, K, 1, 1)).view(-1, H * W)
+        # Draw K fresh samples per observation, or replay the samples of previously drawn noise (then K is read off the noise)
+        if noise is None:
+            noise = self.sample_noise(B, K, data.device, index=index)
+        eps1, eps2 = noise
+        K = eps1.shape[1]
+
+        # Give each observation its own sample axis: x = (B, 1, H*W)
+        x = data.view(B, 1, H * W)
 
         # Encode the model and retrieve estimated distribution parameters mu and log(standard deviation) for each sample of each observation
-        # z1 holds the latent samples generated at the first stochastic layer.
-        mu, log_std, [x, z1] = self.encode(data_k_vec)
+        # mu1 and log_std1 parametrize q(h1|x) and z1 holds the latent samples generated at the first stochastic layer.
+        with self.layer_autocast(data.device):
+            if rows is not None:
+                # Encode each observation once, then every sample becomes a row of its own that shares its observation's q(h1|x)
+                mu1, log_std1 = self.encode_h1(x)
+                x, mu1, log_std1 = x[rows], mu1[rows], log_std1[rows]
+                z1 = self.reparameterize(mu1, log_std1, eps=eps1)
+                mu, log_std = self.encode_z(z1)
+            elif self.encode_once:
+                # The first layer is deterministic in x, so it runs once per observation and (B, 1, #latents) mu1/log_std1 broadcast against the K samples
+                mu, log_std, [mu1, log_std1, z1] = self.encode(x, eps=eps1)
+            else:
+                # Generate K copies of each observation and encode every copy
+                mu, log_std, [mu1, log_std1, z1] = self.encode(
+                    x.repeat((1, K, 1)), eps=eps1
+                )
+        mu, log_std = mu.float(), log_std.float()
+        mu1, log_std1 = mu1.float(), log_std1.float()
 
         # Sample from each observation's approximated latent distribution in each row (i.e. once for each of K importance samples, represented by rows)
         # (this uses the reparametrization trick!)
-        z = model.reparameterize(mu, log_std)
+        z = self.reparameterize(mu, log_std, eps=eps2)
+
+        if dreg_scale is not None:
+            # DReG drops the score function terms: the encoder's gradient may only reach log q through the samples z1 and z.
+            # q(h1|x) only depends on x, and q(z|h1) is re-evaluated with detached weights so that it still sees z1
+            mu1, log_std1 = mu1.detach(), log_std1.detach()
+            # z already holds the path through z1, so the remaining uses of z1 get their own autograd node whose gradient is rescaled below
+            z1 = z1.view_as(z1)
+            with self.layer_autocast(data.device):
+                mu, log_std = self.encode_z(z1, detach_params=True)
+            mu, log_std = mu.float(), log_std.float()
 
         # Calculate Log p(z) (prior) - how likely are these values given the prior assumption N(0,1)?
-        log_p_z = torch.sum(-0.5 * z**2, 1) - 0.5 * z.shape[1] * T.log(
-            torch.tensor(2 * np.pi)
-        )
+        log_p_z = standard_normal_log_prob(z, axis=2)
 
         # Calculate q (z | h1) - how likely are the generated output latent samples given the distributions they came from?
-        log_qz_h1 = compute_log_probabitility_gaussian(z, mu, log_std)
-
-        # Re-Generate the mu and log_std that generated the first-layer latents z1
-        h1 = torch.tanh(self.fc1(x))
-        h2 = torch.tanh(self.fc2(h1))
-        mu, log_std = self.fc31(h2), self.fc32(h2)
+        log_qz_h1 = gaussian_log_prob(z, mu, log_std, axis=2)
 
         # Calculate log q(h1|x) - how likely are the first-stochastic-layer latents given the distributions they come from?
-        log_qh1_x = compute_log_probabitility_gaussian(z1, mu, log_std)
+        # The encoder already returned the mu and log_std that generated z1, so no layer is run a second time
+        log_qh1_x = gaussian_log_prob(z1, mu1, log_std1, axis=2)
 
-        # Calculate the distribution parameters that generated the first-layer latents upon decoding
-        h5 = torch.tanh(self.fc7(z))
-        h6 = torch.tanh(self.fc8(h5))
-        mu, log_std = self.fc81(h6), self.fc82(h6)
+        # Decode the encoder's first-layer latents z1, retrieving the decoder's last hidden layer and the parameters of p(h1|z) in the same pass
+        with self.layer_autocast(data.device):
+            hidden, [mu_h1, log_std_h1, _] = self.decode_layers(z, z1=z1)
+        mu_h1, log_std_h1 = mu_h1.float(), log_std_h1.float()
 
         # Calculate log p(h1|z) - how likely are the latents z1 under the parameters of the distribution here?
         #   (This directly encourages the decoder to learn the inverse of the map h1->z)
-        log_ph1_z = compute_log_probabitility_gaussian(z1, mu, log_std)
-
-        # Finally calculate the reconstructed image
-        h7 = torch.tanh(self.fc9(z1))
-        h8 = torch.tanh(self.fc10(h7))
-        decoded = torch.sigmoid(self.fc11(h8))
+        log_ph1_z = gaussian_log_prob(z1, mu_h1, log_std_h1, axis=2)
 
         # calculate log p(x | h1) - how likely is the reconstruction given the latent samples that generated it?
-        log_px_h1 = compute_log_probabitility_bernoulli(decoded, x)
+        # x = (B, 1, H*W) broadcasts against the (B, K, H*W) reconstruction
+        with self.layer_autocast(data.device):
+            log_px_h1 = self.bernoulli_log_likelihood(hidden, self.fc11, x)
 
-        # Begin calculating L_alpha depending on the (a) model type, and (b) optimization method
         # log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x =
         #           log([p(z0_i)p(x|z1_i)p(z1_i|z0_i)]/[q(z0_i|z1_i)q(z1_i|x)]) = log(p(x,z0_i,z1_i)/q(z0_i,z1_i|x)) = L_VI
-        #   (for each importance sample i out of K for each observation)
-        # Note that if test==True then we're always using the IWAE objective!
-        if model_type == "iwae" or test == True:
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            log_w_matrix = (
-                log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x
-            ).view(-1, K)
-
-        elif model_type == "vae":
-            # Don't reorder, and divide by K in anticipation of taking a batch sum of (1/K)*SUM(log(p(x,z)/q(z|x)))
-            log_w_matrix = (
-                (log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x).view(-1, 1)
-                * 1
-                / K
-            )
-            return -torch.sum(log_w_matrix)
-
-        elif model_type == "general_alpha" or model_type == "vralpha":
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            # Multiply by (1-alpha) because (1-alpha)* log(p(x,z_i)/q(z_i|x)) =  log([p(x,z_i)/q(z_i|x)]^(1-alpha))
-            log_w_matrix = (
-                log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x
-            ).view(-1, K) * (1 - self.alpha)
-
-        elif model_type == "vrmax":
-            # Re-order the entries so that each row holds the K importance samples for each observation
-            # Take the max in each row, representing the maximum-weighted sample, then immediately return batch sum loss -L_alpha
-            log_w_matrix = (
-                (log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x)
-                .view(-1, K)
-                .max(axis=1, keepdim=True)
-                .values
-            )
-            return -torch.sum(log_w_matrix)
-
-        # Begin using the "max trick". Subtract the maximum log(*) sample value for each observation.
-        # log_w_minus_max = log([p(z_i,x)/q(z_i|x)] / max([p(z_k,x)/q(z_k|x)]))
-        log_w_minus_max = log_w_matrix - torch.max(log_w_matrix, 1, keepdim=True)[0]
-
-        # Exponentiate so that each term is [p(z_i,x)/q(z_i|x)] / max([p(z_k,x)/q(z_k|x)]) (no log)
-        ws_matrix = torch.exp(log_w_minus_max)
-
-        # Calculate normalized weights in each row. Max denominators cancel out!
-        # ws_norm = [p(z_i,x)/q(z_i|x)]/SUM([p(z_k,x)/q(z_k|x)])
-        ws_norm = ws_matrix / torch.sum(ws_matrix, 1, keepdim=True)
-
-        if model_type == "vralpha" and not test:
-            # If we're specifically using a VR-alpha model, we want to choose a sample to backprop according to the values in ws_norm above
-            # So we make a distribution in each row
-            sample_dist = Multinomial(1, ws_norm)
-
-            # Then we choose a sample in each row acccording to this distribution
-            ws_sum_per_datapoint = log_w_matrix.gather(
-                1, sample_dist.sample().argmax(1, keepdim=True)
-            )
-        else:
-            # For any other model, we're taking the full sum at this point
-            ws_sum_per_datapoint = torch.sum(log_w_matrix * ws_norm, 1)
-
-        if model_type in ["general_alpha", "vralpha"] and not test:
-            # For both VR-alpha and directly estimating L_alpha with a sum, we have to renormalize the sum with 1-alpha
-            ws_sum_per_datapoint /= 1 - alpha
-
-        loss = -torch.sum(ws_sum_per_datapoint)
-
-        return loss
-
-
-# Compute N(obs| mu, sigma) for all K samples and sum over probabilities of the K samples
-def compute_log_probabitility_gaussian(obs, mu, logstd, axis=1):
-    return torch.sum(
-        -0.5 * ((obs - mu) / torch.exp(logstd)) ** 2 - logstd, axis
-    ) - 0.5 * obs.shape[1] * T.log(torch.tensor(2 * np.pi))
+        #   (for each importance sample i out of K for each observation, so each row holds the K importance samples of one observation)
+        log_w = log_p_z + log_ph1_z + log_px_h1 - log_qz_h1 - log_qh1_x
+
+        if dreg_scale is not None:
+            # Only the encoder's gradient flows back through the latents, so rescaling it per sample leaves the decoder's gradient alone
+            latent_grad_scale = dreg_scale(log_w.detach()).unsqueeze(2)
+            z.register_hook(lambda grad: grad * latent_grad_scale)
+            z1.register_hook(lambda grad: grad * latent_grad_scale)
+
+        return log_w, noise
+
+    def compute_loss_for_batch(self, data, objective):
+        return objective(self, data)
+
+
+# Draw the (B, K, dims[l]) noise of every stochastic layer from source. Counter-based noise comes from counter_noise,
+# keyed by the dataset indices index = (B,) and the sample indices samples ((K,) or (B, K), default 0..K-1)
+def draw_noise(
+    source, B, K, dims, device, counter_noise=None, index=None, samples=None
+):
+    if source != "counter":
+        return sample_normal_noise(B, K, dims, device, source=source)
+    if index is None:
+        raise ValueError("counter-based noise needs the dataset indices of the batch")
+    if samples is None:
+        samples = torch.arange(K, device=device)
+    return counter_noise.normal(index, samples, dims, device)
+
+
+# Compute Ber(obs| sigmoid(logits)) for all K samples and sum over probabilities of the K samples
+def compute_log_probabitility_bernoulli_logits(logits, obs, axis=1):
+    # obs*log(sigmoid(l)) + (1-obs)*log(1-sigmoid(l)) is minus the binary cross entropy with logits, which PyTorch
+    # evaluates in one numerically stable pass without an epsilon. obs may broadcast against logits.
+    # Logits coming out of bf16 layers are summed over the pixels in fp32
+    logits = logits.float()
+    return -torch.sum(
+        F.binary_cross_entropy_with_logits(
+            logits, obs.expand_as(logits), reduction="none"
+        ),
+        axis,
+    )
 
 
-# Compute Ber(obs| theta) for all K samples and sum over probabilities of the K samples
-def compute_log_probabitility_bernoulli(theta, obs, axis=1):
-    # 1e-18 needed to avoid numerical errors
-    return torch.sum(
-        obs * torch.log(theta + 1e-18) + (1 - obs) * torch.log(1 - theta + 1e-18), axis
-    )
+# Compute Ber(obs| sigmoid(output_layer(hidden))) summed over the pixels, producing the logits of only block_size pixels at a time.
+# The in-place arithmetic makes this an evaluation-only (no gradient) kernel
+def compute_log_probabitility_bernoulli_blocked(hidden, output_layer, obs, block_size):
+    log_p = 0
+    for start in range(0, output_layer.out_features, block_size):
+        end = start + block_size
+        logits = F.linear(
+            hidden, output_layer.weight[start:end], output_layer.bias[start:end]
+        ).float()
+        # log(sigmoid(l)) = l - softplus(l) and log(1 - sigmoid(l)) = -softplus(l), so
+        # obs*log(theta) + (1-obs)*log(1-theta) = obs*l - softplus(l) for theta = sigmoid(l)
+        softplus = F.softplus(logits)
+        log_p = log_p + torch.sum(logits.mul_(obs[..., start:end]).sub_(softplus), -1)
+    return log_p
 
 
 # train and test functions
 def train(epoch):
     model.train()
     train_loss = 0
-    for batch_idx, (data, labels) in enumerate(train_loader):
-        # (B, 1, F1, F2) (e.g. (128, 1, 28, 28) for MNIST with B=128)
+    for batch_idx, (data, labels, index, rows) in enumerate(train_loader):
+        # (B, 1, F1, F2) (e.g. (128, 1, 28, 28) for MNIST with B=128); rows is the CSR form of a binary batch, else None
         data = data.to(device)
         optimizer.zero_grad()
+        # Every optimization step gets its own counter-based noise stream
+        model.counter_noise.step = (epoch - 1) * len(train_loader) + batch_idx + 1
 
-        loss = model.compute_loss_for_batch(data, model)
-        with detect_anomaly():
-            loss.backward()
+        # The objective runs the backward pass itself, since the chunked losses backpropagate one chunk of the K samples at a time.
+        # index holds the dataset indices of the batch, for objectives that track statistics per datapoint
+        with sparse_inputs(model, data, rows):
+            loss = objective.backward(model, data, index.to(device))
         train_loss += loss.item()
         optimizer.step()
 
@@ -389,72 +581,311 @@ def train(epoch):
         logging.info(
             f"====> Epoch: {epoch} Average loss: {train_loss / len(train_loader.dataset):.4f}"
         )
+        # Per-observation statistics the objective gathered since the last log, e.g. the weight telemetry or what truncated backprop dropped
+        for name, value in objective.summary().items():
+            message = f"====> Epoch: {epoch} Average {name}: {value:.4f}"
+            print(message)
+            logging.info(message)
+
+
+# The model of the configured architecture with the hyperparameters above, unless settings override them (e.g. mixed_precision=False)
+def build_model(layers=L, **settings):
+    return (mnist_omniglot_model1 if layers == 1 else mnist_omniglot_model2)(
+        alpha, **settings
+    )
 
 
-def _test(epoch):
+# Per-datapoint test bounds of model on dataset in dataset order, plus the nested-K curve. Every shard of test_batch_size
+# observations draws its noise from its own seed, so the result only depends on the weights and the test settings, for any test_workers
+def score_test_set(model, dataset):
+    # Counter-based test noise is the same at every evaluation, so test NLLs of different epochs score the same samples
+    model.counter_noise.step = 0
+    # With test_workers > 1 each worker evaluates shards of the test set with a CPU copy of the model
+    stats = evaluate_sharded(
+        model,
+        dataset,
+        test_K,
+        test_memory_budget,
+        test_workers,
+        test_batch_size,
+        seed=seed,
+        ks=test_nested_K,
+        sequential=(test_stderr_tolerance, test_min_K) if test_sequential_K else None,
+        make_rows=binary_rows if sparse_first_layer else None,
+    )
+    curve = stats.pop("curve", None)
+    stats["curve"] = curve.summary() if curve is not None else None
+    return stats
+
+
+# score_test_set, looked up in (and added to) test_cache_dir when use_cache is set. Returns (stats, whether they were cached).
+# Only worth it for weights that get tested again: the final ones, which test_checkpoint scores again from their models/*.pt file
+def test_bounds(model, dataset, split, use_cache=False):
+    # Everything the per-datapoint bounds depend on besides the weights: what is sampled (split, K, noise, seed, the
+    # shard size that seeds are assigned by, and the memory budget that sizes the sequential rounds) and the numerics
+    spec = {
+        "split": split,
+        "K": test_K,
+        "estimator": "iwae",
+        "noise": model.test_noise,
+        "seed": seed,
+        "nested_K": sorted(test_nested_K or []),
+        "batch_size": test_batch_size,
+        "memory_budget": test_memory_budget,
+        "sequential": (
+            [test_stderr_tolerance, test_min_K] if test_sequential_K else None
+        ),
+        "mixed_precision": model.mixed_precision,
+        "encode_once": model.encode_once,
+        "sparse_first_layer": sparse_first_layer,
+        "fused_eval_likelihood": model.fused_eval_likelihood,
+        "eval_pixel_block": model.eval_pixel_block,
+    }
+    if test_cache_dir is None or not use_cache:
+        return score_test_set(model, dataset), False
+    return EvaluationCache(test_cache_dir).get_or_compute(
+        model, spec, lambda: score_test_set(model, dataset)
+    )
+
+
+def _test(epoch, use_cache=False):
     model.eval()
-    test_loss = 0
+    stats, cached = test_bounds(
+        model, test_loader.dataset, f"{data_name}/test", use_cache=use_cache
+    )
+    if cached:
+        print(f"====> Epoch: {epoch} Test set bounds loaded from {test_cache_dir}")
+        logging.info(
+            f"====> Epoch: {epoch} Test set bounds loaded from {test_cache_dir}"
+        )
+
     with torch.no_grad():
-        for i, (data, labels) in enumerate(test_loader):
-            data = data.to(device)
-            recon_batch, mu, logvar = model(data)
-            loss = model.compute_loss_for_batch(data, model, K=5000, test=True)
-            test_loss += loss.item()
-            if i == 0:
-                # Visualizing reconstructions
-                n = min(data.size(0), 8)
-                comparison = torch.cat(
-                    [data[:n], recon_batch.view(test_batch_size, 1, 28, 28)[:n]]
-                )
-                save_image(
-                    comparison.cpu(),
-                    f"results/reconstruction_{model_type}_L={L}_{data_name}_alpha={alpha}_K={K}_epoch={epoch}.png",
-                    nrow=n,
-                )
-                # Visualizing random samples from the latent space
-                noise = torch.randn(64, 50).to(device)
-                sample = model.decode(noise).cpu()
-                save_image(
-                    sample.view(64, 1, 28, 28),
-                    f"results/sample_{model_type}_L={L}_{data_name}_alpha={alpha}_K={K}_epoch={epoch}.png",
-                )
-    test_loss /= len(test_loader.dataset)
+        data = next(iter(test_loader))[0].to(device)
+        recon_batch, mu, logvar = model(data)
+        save_test_images(epoch, data, recon_batch)
+
+    # Same value as IWAEObjective(test_K)(model, data), averaged over the test set
+    test_loss = -torch.mean(stats["self_normalized_mean"]).item()
+    # -log((1/K)*SUM(p(x,z_k)/q(z_k|x))), the IWAE estimate of -log p(x)
+    test_nll = -torch.mean(stats["log_mean_exp"]).item()
     print(f"====> Epoch: {epoch} Test set loss: {test_loss:.4f}")
     logging.info(f"====> Epoch: {epoch} Test set loss: {test_loss:.4f}")
+    print(f"====> Epoch: {epoch} Test set NLL (K={test_K}): {test_nll:.4f}")
+    logging.info(f"====> Epoch: {epoch} Test set NLL (K={test_K}): {test_nll:.4f}")
+    if test_sequential_K:
+        # Monte Carlo error bar of the test NLL from the per-observation standard errors, and how many samples it took
+        stderr = torch.sqrt(torch.sum(stats["stderr"] ** 2)).item() / len(stats["K"])
+        k = stats["K"].double()
+        message = (
+            f"====> Epoch: {epoch} Test set NLL error bar: +/- {stderr:.4f} with K min {int(k.min())} "
+            f"median {int(k.median())} mean {k.mean().item():.1f} max {int(k.max())} "
+            f"({k.sum().item() / (test_K * len(k)):.1%} of the test_K budget)"
+        )
+        print(message)
+        logging.info(message)
+    if test_nested_K:
+        # The K'-sample bounds average disjoint blocks of the test_K samples; the error bar comes from the spread across blocks
+        for k, point in stats["curve"].items():
+            message = (
+                f"====> Epoch: {epoch} Test set NLL (K={k}): {-point['bound']:.4f}"
+            )
+            if point["stderr"] is not None:
+                message += f" +/- {point['stderr']:.4f}"
+            print(message)
+            logging.info(message)
+    if test_renyi_alphas:
+        # Every alpha rescales the same samples, so the whole sweep costs one pass over the test set
+        with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+            torch.manual_seed(seed)
+            sweep = renyi_bound_sweep(
+                model,
+                test_loader,
+                test_renyi_alphas,
+                test_K,
+                test_memory_budget,
+                device,
+            )
+        for a, bound in zip(sweep["alphas"].tolist(), sweep["renyi"].tolist()):
+            message = f"====> Epoch: {epoch} Test set L_alpha (alpha={a:g}, K={test_K}): {bound:.4f}"
+            print(message)
+            logging.info(message)
+        message = f"====> Epoch: {epoch} Test set VR-max bound (K={test_K}): {sweep['vrmax']:.4f}"
+        print(message)
+        logging.info(message)
     return test_loss
 
 
-def load_data_and_initialize_loaders(data_name, train_batch, test_batch):
+def save_test_images(epoch, data, recon_batch):
+    # Visualizing reconstructions
+    n = min(data.size(0), 8)
+    comparison = torch.cat([data[:n], recon_batch.view(data.size(0), 1, 28, 28)[:n]])
+    save_image(
+        comparison.cpu(),
+        f"results/reconstruction_{model_type}_L={L}_{data_name}_alpha={alpha}_K={K}_epoch={epoch}.png",
+        nrow=n,
+    )
+    # Visualizing random samples from the latent space
+    noise = torch.randn(64, 50).to(device)
+    sample = model.decode(noise).cpu()
+    save_image(
+        sample.view(64, 1, 28, 28),
+        f"results/sample_{model_type}_L={L}_{data_name}_alpha={alpha}_K={K}_epoch={epoch}.png",
+    )
+
+
+# Runs once in the background test process: rebuild the model and the test loader there, on the CPU with the process's own thread budget
+def init_background_test(num_threads):
+    global device, model, test_loader, background_log
+    torch.set_num_threads(num_threads)
+    # Keep what _test logs here, so test_snapshot can hand it back to the trainer's run log
+    background_log = logging.handlers.BufferingHandler(capacity=10**6)
+    logging.getLogger().addHandler(background_log)
+    logging.getLogger().setLevel(logging.INFO)
+    device = torch.device("cpu")
+    model = build_model()
+    _, test_loader = load_data_and_initialize_loaders(
+        data_name, train_batch_size, test_batch_size
+    )
+
+
+# Test the weights of an epoch in the background test process; returns the messages _test logged, all tagged with the epoch
+def test_snapshot(epoch, state_dict):
+    model.load_state_dict(state_dict)
+    background_log.flush()
+    _test(epoch)
+    return [record.getMessage() for record in background_log.buffer]
+
+
+# Test bounds of saved weights: a models/*.pt file written at the end of training, or a state_dict loaded elsewhere, of a
+# model with the given number of stochastic layers, scored on the test set of name with the current test settings. They go
+# through test_cache_dir, so weights that were scored before (e.g. the final weights by _test) are loaded instead of rescored
+def test_checkpoint(checkpoint, layers=L, name=data_name, root="./data"):
+    if isinstance(checkpoint, str):
+        checkpoint = torch.load(checkpoint, map_location=device)
+    checkpoint_model = build_model(layers).to(device)
+    checkpoint_model.load_state_dict(checkpoint)
+    checkpoint_model.eval()
+    _, loader = load_data_and_initialize_loaders(
+        name, train_batch_size, test_batch_size, root=root
+    )
+    return test_bounds(
+        checkpoint_model, loader.dataset, f"{name.lower()}/test", use_cache=True
+    )[0]
+
+
+# Write the messages of the background tests that have finished into the run log (the test process printed them already)
+def log_background_tests(finished):
+    for epoch, messages in finished:
+        for message in messages:
+            logging.info(message)
+
+
+# Test NLL from annealed importance sampling, a tighter estimate of -log p(x) than the IWAE bound of _test
+def ais_test(epoch):
+    model.eval()
+    test_nll = 0
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        torch.manual_seed(seed)
+        for data, labels, index, rows in test_loader:
+            data = data.to(device)
+            with sparse_inputs(model, data, rows):
+                stats = annealed_importance_sampling(
+                    model,
+                    data,
+                    ais_chains,
+                    ais_steps,
+                    test_memory_budget,
+                    leapfrog_steps=ais_leapfrog_steps,
+                )
+            test_nll += -torch.sum(stats.log_mean_exp()).item()
+    test_nll /= len(test_loader.dataset)
+    message = f"====> Epoch: {epoch} Test set AIS NLL ({ais_chains} chains, {ais_steps} steps): {test_nll:.4f}"
+    print(message)
+    logging.info(message)
+    return test_nll
+
+
+# Test NLL with the layers in fp32 and under bf16 autocast, on the same batches and the same noise, to check what mixed precision costs.
+# Each precision gets its own copy of the weights, so the model that is being trained (or tested in the background) is left alone
+def mixed_precision_parity(epoch):
+    models = {}
+    for precision in [False, True]:
+        models[precision] = build_model(mixed_precision=precision).to(device)
+        models[precision].load_state_dict(model.state_dict())
+        models[precision].eval()
+    test_nll = {False: 0, True: 0}
+    model.counter_noise.step = 0
+    with torch.no_grad():
+        for data, labels, index, rows in test_loader:
+            data = data.to(device)
+            index = index.to(device)
+            chunk_size = chunk_size_for_budget(
+                model, data.shape[0], test_K, test_memory_budget
+            )
+            for precision, precision_model in models.items():
+                # Both precisions start from the same RNG state, so they score exactly the same samples
+                with torch.random.fork_rng(
+                    devices=[data.device] if data.is_cuda else []
+                ), sparse_inputs(precision_model, data, rows):
+                    stats = evaluate_log_weights(
+                        precision_model, data, test_K, chunk_size, index=index
+                    )
+                test_nll[precision] += -torch.sum(stats.log_mean_exp()).item()
+    fp32_nll = test_nll[False] / len(test_loader.dataset)
+    bf16_nll = test_nll[True] / len(test_loader.dataset)
+    message = f"====> Epoch: {epoch} Test set NLL (K={test_K}) fp32: {fp32_nll:.4f} bf16: {bf16_nll:.4f} drift: {bf16_nll - fp32_nll:+.4f}"
+    print(message)
+    logging.info(message)
+    return bf16_nll - fp32_nll
+
+
+# Dataset wrapper that also yields the index of each item, so statistics can be tracked per datapoint across epochs
+class IndexedDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        data, label = self.dataset[index]
+        return data, label, index
+
+
+# Collate (data, label, index) items and add the CSR form of the data when it is binary and sparse_first_layer is set.
+# It runs in the loader's workers on the CPU, so the model never waits for the nonzero pixels to be found
+def collate_with_rows(batch):
+    data, labels, index = torch.utils.data.default_collate(batch)
+    return data, labels, index, binary_rows(data) if sparse_first_layer else None
+
+
+def load_data_and_initialize_loaders(data_name, train_batch, test_batch, root="./data"):
     data_name = data_name.lower()
-    kwargs = {"num_workers": 1, "pin_memory": True}
+    kwargs = {"num_workers": 1, "pin_memory": True, "collate_fn": collate_with_rows}
     if data_name == "mnist":
         train_data = datasets.MNIST(
-            "./data", train=True, download=True, transform=transforms.ToTensor()
-        )
-        test_data = datasets.MNIST(
-            "./data", train=False, transform=transforms.ToTensor()
+            root, train=True, download=True, transform=transforms.ToTensor()
         )
+        test_data = datasets.MNIST(root, train=False, transform=transforms.ToTensor())
     elif data_name == "fashion" or data_name == "fashionmnist":
         train_data = datasets.FashionMNIST(
-            "./data", train=True, download=True, transform=transforms.ToTensor()
+            root, train=True, download=True, transform=transforms.ToTensor()
         )
         test_data = datasets.FashionMNIST(
-            "./data", train=False, transform=transforms.ToTensor()
+            root, train=False, transform=transforms.ToTensor()
         )
     train_loader = torch.utils.data.DataLoader(
-        train_data, batch_size=train_batch, shuffle=True, **kwargs
+        IndexedDataset(train_data), batch_size=train_batch, shuffle=True, **kwargs
     )
     test_loader = torch.utils.data.DataLoader(
-        test_data, batch_size=test_batch, shuffle=True, **kwargs
+        IndexedDataset(test_data), batch_size=test_batch, shuffle=True, **kwargs
     )
     return train_loader, test_loader
 
 
 if __name__ == "__main__":
-    if L == 1:
-        model = mnist_omniglot_model1(alpha).to(device)
-    else:
-        model = mnist_omniglot_model2(alpha).to(device)
+    torch.autograd.set_detect_anomaly(detect_anomalies)
+    model = build_model().to(device)
     train_loader, test_loader = load_data_and_initialize_loaders(
         data_name, train_batch_size, test_batch_size
     )
@@ -464,13 +895,59 @@ if __name__ == "__main__":
 
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
+    # The objective is configured once here; nothing below reads model_type or alpha to compute the loss
+    objective = make_objective(
+        model_type,
+        K,
+        alpha,
+        sparse_backprop=sparse_backprop,
+        dreg=dreg,
+        chunk_size=k_chunk_size,
+        analytic_kl=analytic_kl,
+        truncate_mass=truncate_mass,
+        truncate_top_k=truncate_top_k,
+        adaptive_k=adaptive_k,
+        num_datapoints=len(train_loader.dataset),
+        device=device,
+        adaptive_min_k=adaptive_min_k,
+        record_weights=weight_telemetry,
+    )
+    if compile_objective:
+        # Compile with a training-shaped batch before the first epoch, so the first steps are not timed with compilation
+        objective.compile(
+            model, example_data=torch.zeros(train_batch_size, 1, 28, 28, device=device)
+        )
+
     print(f"{datetime.datetime.now()} \nStarting training")
     logging.info(f"{datetime.datetime.now()} \nStarting training")
+    if background_test:
+        # The test process gets its own cores, so the two processes do not compete for them
+        torch.set_num_threads(max(1, torch.get_num_threads() - background_test_threads))
+        snapshot_bytes = sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in model.state_dict().values()
+        )
+        evaluator = BackgroundEvaluator(
+            init_background_test,
+            num_threads=background_test_threads,
+            max_pending=max(1, background_test_memory // snapshot_bytes),
+        )
     for e in range(1, epochs + 1):
         train(e)
         if e % test_interval == 0:
-            _test(e)
-    _test(epochs)
+            if background_test:
+                # Collects the tests that have finished (re-raising their errors), which also frees their slots
+                log_background_tests(evaluator.poll())
+                log_background_tests(evaluator.submit(test_snapshot, e, model))
+            else:
+                _test(e)
+    if background_test:
+        log_background_tests(evaluator.close())
+    _test(epochs, use_cache=True)
+    if ais_chains > 0:
+        ais_test(epochs)
+    if mixed_precision and mixed_precision_parity_check:
+        mixed_precision_parity(epochs)
     print(datetime.datetime.now())
     logging.info(datetime.datetime.now())
     print("Training finished")
@@ -16,10 +16,15 @@ from torch.utils.data import DataLoader, TensorDataset
 from scipy.io import loadmat
 import logging
 import math
+import sys
 
 from matplotlib import pyplot as plt
 import matplotlib
 
+# example_models lives at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from example_models import test_checkpoint
+
 seed = 1
 K = 50
 torch.manual_seed(seed)
@@ -147,6 +152,13 @@ def make_plot(save_recons=True):
         shuffle=True,
     )
 
+    # Test NLL of both checkpoints; bounds of weights that were tested before are loaded from the evaluation cache
+    for name, checkpoint in [("alpha=-500", modelneg500), ("alpha=500", modelplus500)]:
+        stats = test_checkpoint(
+            checkpoint.state_dict(), layers=1, name="mnist", root="../data"
+        )
+        print(f"Test NLL ({name}): {-torch.mean(stats['log_mean_exp']).item():.4f}")
+
     minibatch = next(iter(train_loader))[0]  # Shuffle then give 1000 samples
 
     decodedneg500, muneg500, logstdneg500 = modelneg500.forward(minibatch)
@@ -0,0 +1,113 @@
+import contextlib
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# Number of entries CSRRows pads its columns up to a multiple of, so compiled graphs see few distinct shapes
+CSR_BUCKET = 8192
+
+
+def _not_compiled(fn):
+    # Keep fn out of torch.compile graphs: which path it takes depends on the batch bound by sparse_inputs, which
+    # graph capture cannot guard on, so it runs eagerly between the compiled parts instead of forcing recompiles
+    disable = getattr(getattr(torch, "compiler", None), "disable", None)
+    return disable(fn) if disable is not None else fn
+
+
+# Rows of a mostly-zero batch stored as the lists of their nonzero columns (CSR).
+class CSRRows:
+    def __init__(self, columns, offsets, values, shape):
+        self.columns = columns
+        self.offsets = offsets
+        self.values = values
+        self.shape = shape
+
+    # Store the rows of x by their nonzero entries.
+    # Finding the nonzero entries reads their number back from the device, so build the rows where the batch is
+    # assembled (e.g. in the DataLoader's collate_fn, on the CPU) rather than in the model.
+    @classmethod
+    def from_dense(cls, x, bucket=None):
+        flat = x.reshape(-1, x.shape[-1])
+        rows, columns = torch.nonzero(flat, as_tuple=True)
+        counts = torch.bincount(rows, minlength=flat.shape[0])
+        offsets = torch.cumsum(counts, 0) - counts
+        values = flat[rows, columns]
+        # Binarized pixels are all 1 where they are nonzero, so the sums need no weights at all
+        if bool(torch.all(values == 1)):
+            values = None
+
+        padding = -columns.numel() % bucket if bucket else 0
+        if padding:
+            if values is None:
+                values = torch.ones_like(columns, dtype=x.dtype)
+            columns = torch.cat([columns, columns.new_zeros(padding)])
+            values = torch.cat([values, values.new_zeros(padding)])
+        return cls(columns, offsets, values, x.shape)
+
+    def to(self, device):
+        return CSRRows(
+            self.columns.to(device),
+            self.offsets.to(device),
+            None if self.values is None else self.values.to(device),
+            self.shape,
+        )
+
+    def density(self):
+        return self.columns.numel() / max(self.shape.numel(), 1)
+
+
+# CSRRows of a binary batch, or None for any other batch, which the dense matmul handles better.
+def binary_rows(data, bucket=CSR_BUCKET):
+    if not bool(torch.all((data == 0) | (data == 1))):
+        return None
+    return CSRRows.from_dense(data.reshape(data.shape[0], -1), bucket=bucket)
+
+
+# Let every SparseInputLinear of model use rows, the CSRRows of data, whenever it is fed data itself.
+# A layer recognizes data by its storage, so reshaped views of data (e.g. data.view(B, 1, H*W)) take the sparse path,
+# while copies such as data[rows] or data.repeat(...) fall back to the dense matmul. rows = None binds nothing.
+@contextlib.contextmanager
+def sparse_inputs(model, data, rows):
+    layers = [m for m in model.modules() if isinstance(m, SparseInputLinear)]
+    if rows is not None:
+        rows = rows.to(data.device)
+        for layer in layers:
+            layer.bound = (data, rows)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.bound = None
+
+
+# nn.Linear for mostly-zero inputs, e.g. the pixels of binarized MNIST digits.
+# When its input is a batch bound by sparse_inputs, the layer sums the weight columns of the nonzero pixels of
+# each row (scaled by the pixel values unless the rows are binary) instead of running the dense (N, F) x (F, H)
+# matmul, and the weight gradient is scattered into those columns only. Any other input takes the dense matmul.
+# The parameters are those of nn.Linear, so checkpoints load either way.
+class SparseInputLinear(nn.Linear):
+    def __init__(self, in_features, out_features, bias=True):
+        super(SparseInputLinear, self).__init__(in_features, out_features, bias=bias)
+        self.bound = None
+
+    @_not_compiled
+    def forward(self, x):
+        if self.bound is None:
+            return super(SparseInputLinear, self).forward(x)
+        data, rows = self.bound
+        if x.data_ptr() != data.data_ptr() or x.numel() != data.numel():
+            return super(SparseInputLinear, self).forward(x)
+
+        # Row f of weight.t() is the weight column of input pixel f; embedding_bag gathers and sums the active
+        # ones of every row, and its backward only accumulates into those rows
+        h = F.embedding_bag(
+            rows.columns,
+            self.weight.t(),
+            rows.offsets,
+            mode="sum",
+            per_sample_weights=rows.values,
+        )
+        if self.bias is not None:
+            h = h + self.bias
+        return h.view(*x.shape[:-1], self.out_features)
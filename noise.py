@@ -0,0 +1,111 @@
+import torch
+
+# Keeps the inverse normal CDF finite at the edges of the unit cube
+_UNIFORM_EPS = 1e-7
+
+
+# Draw independent standard normal noise.
+def iid_normal(B, K, D, device):
+    return torch.randn(B, K, D, device=device)
+
+
+# Draw standard normal noise in antithetic pairs.
+# Samples 2i and 2i + 1 of each data point are eps and -eps, so any even number of leading samples
+# is exactly balanced around the mean of q. An odd K ends with one unpaired draw.
+def antithetic_normal(B, K, D, device):
+    eps = torch.randn(B, (K + 1) // 2, 1, D, device=device)
+    return torch.cat([eps, -eps], 2).view(B, -1, D)[:, :K]
+
+
+# Draw randomized quasi-Monte Carlo standard normal noise.
+# One scrambled Sobol point set of K points is shared by all data points, and each data point gets its
+# own uniform random shift modulo 1 (Cranley-Patterson rotation). Every sample is then marginally
+# N(0, I), so the importance sampling estimators stay unbiased, while the K samples of a data point
+# cover the latent space more evenly than i.i.d. draws. The point set is most uniform when K is a power of 2.
+def sobol_normal(B, K, D, device):
+    # Seed the scrambling from the global generator so torch.manual_seed makes the points reproducible
+    seed = int(torch.randint(2**31 - 1, (1,)))
+    engine = torch.quasirandom.SobolEngine(D, scramble=True, seed=seed)
+    points = engine.draw(K).to(device)
+    shift = torch.rand(B, 1, D, device=device)
+    u = torch.frac(points + shift).clamp_(_UNIFORM_EPS, 1 - _UNIFORM_EPS)
+    return torch.special.ndtri(u)
+
+
+NOISE_SOURCES = {
+    "iid": iid_normal,
+    "antithetic": antithetic_normal,
+    "sobol": sobol_normal,
+}
+
+
+# Draw the reparametrization noise of every stochastic layer from one noise source.
+# The layers are drawn jointly as one (B, K, sum(dims)) block, so a quasi-Monte Carlo point set covers
+# all latent dimensions of a sample together, and then split up per layer.
+def sample_normal_noise(B, K, dims, device, source="iid"):
+    if source not in NOISE_SOURCES:
+        raise ValueError(
+            f"{source} isn't a valid noise source! One of " + ", ".join(NOISE_SOURCES)
+        )
+    noise = NOISE_SOURCES[source](B, K, sum(dims), device)
+    return list(torch.split(noise, dims, 2))
+
+
+# Philox4x32 round multipliers and Weyl key increments (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3")
+_PHILOX_M0 = 0xD2511F53
+_PHILOX_M1 = 0xCD9E8D57
+_PHILOX_W0 = 0x9E3779B9
+_PHILOX_W1 = 0xBB67AE85
+_MASK32 = 0xFFFFFFFF
+
+
+def _mulhilo32(a, b):
+    # High and low 32 bits of the 64-bit product of two 32-bit words. int64 multiplication wraps around,
+    # which keeps all 64 bits of the product; the high word then needs a logical (not arithmetic) shift
+    product = a * b
+    return (product >> 32) & _MASK32, product & _MASK32
+
+
+# Philox4x32 counter-based random number generator on int64 tensors holding 32-bit words.
+# The output is a pure function of (counter, key), so any word of the stream can be regenerated on its own.
+def philox4x32(counter, key, rounds=10):
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo32(c0, _PHILOX_M0)
+        hi1, lo1 = _mulhilo32(c2, _PHILOX_M1)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0 = (k0 + _PHILOX_W0) & _MASK32
+        k1 = (k1 + _PHILOX_W1) & _MASK32
+    return [c0, c1, c2, c3]
+
+
+# Standard normal noise keyed by (seed, step, datapoint index, sample index, layer) through Philox4x32.
+# The noise of any sample can be regenerated on demand instead of being kept in memory, and it does not depend
+# on how the samples are chunked, batched or spread over workers. The training loop sets step, so every
+# optimization step sees fresh noise.
+class CounterNoise:
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.step = 0
+
+    # Noise of the given samples of the given datapoints for every stochastic layer.
+    def normal(self, index, samples, dims, device):
+        index = index.to(device=device, dtype=torch.int64).view(-1, 1, 1)
+        samples = samples.to(device=device, dtype=torch.int64)
+        samples = samples.view(1, -1, 1) if samples.dim() == 1 else samples.unsqueeze(2)
+        key = [self.seed & _MASK32, self.step & _MASK32]
+
+        noise = []
+        for layer, D in enumerate(dims):
+            # Each counter yields four words, so dimension d of a sample comes from word d % 4 of counter block d // 4
+            blocks = torch.arange((D + 3) // 4, device=device, dtype=torch.int64)
+            words = philox4x32(
+                [index, samples, torch.full_like(blocks, layer), blocks], key
+            )
+            words = torch.stack(torch.broadcast_tensors(*words), 3)
+            words = words.flatten(2)[..., :D]
+            # Centre the words in [0, 1) and map them through the inverse normal CDF in double precision
+            u = (words.double() + 0.5) / 2.0**32
+            noise.append(torch.special.ndtri(u).to(torch.get_default_dtype()))
+        return noise
@@ -0,0 +1,654 @@
+import torch
+
+from evaluation import counter_based, noise_chunks, segment_logsumexp, segment_sum
+
+# Compiled (or scripted) loss functions, keyed by (id(model), model key, objective key, record_weights, backend). See Objective.compile
+_COMPILED_LOSSES = {}
+
+
+# The surrogates below map the (B, K) log-weights log(p(x,z_i)/q(z_i|x)) to the per-datapoint quantity whose batch sum is -loss.
+# They are free functions over tensors and a float scale = 1-alpha, so TorchScript can compile them when torch.compile is unavailable.
+
+
+def vae_surrogate(log_w: torch.Tensor, scale: float) -> torch.Tensor:
+    # (1/K)*SUM(log(p(x,z_i)/q(z_i|x))), the Monte Carlo ELBO
+    return torch.mean(log_w, 1)
+
+
+def importance_weighted_surrogate(log_w: torch.Tensor, scale: float) -> torch.Tensor:
+    # SUM(ws_norm * log(p(x,z_i)/q(z_i|x))) with ws_norm ~ [p(x,z_i)/q(z_i|x)]^(1-alpha) held fixed, whose gradient
+    # SUM(ws_norm * dlog_w) is the gradient of L_alpha. The chunked, truncated and DReG losses backpropagate the same estimator.
+    # (1-alpha)*log(p(x,z_i)/q(z_i|x)) = log([p(x,z_i)/q(z_i|x)]^(1-alpha)) and the softmax applies the max trick
+    ws_norm = torch.softmax(log_w.detach() * scale, 1)
+    return torch.sum(log_w * ws_norm, 1)
+
+
+def vrmax_surrogate(log_w: torch.Tensor, scale: float) -> torch.Tensor:
+    # The maximum-weighted sample in each row
+    return torch.max(log_w, 1)[0]
+
+
+def vralpha_surrogate(log_w: torch.Tensor, scale: float) -> torch.Tensor:
+    # One sample per row, chosen with probability ws_norm ~ [p(x,z_i)/q(z_i|x)]^(1-alpha). The (1-alpha) scaling
+    # of the chosen log_w_matrix entry cancels against the renormalization
+    ws_norm = torch.softmax(log_w.detach() * scale, 1)
+    chosen = torch.multinomial(ws_norm, 1)
+    return log_w.gather(1, chosen).squeeze(1)
+
+
+# Rescaling factor of each sample's encoder gradient for the doubly reparameterized estimator of L_alpha (alpha = 0 for IWAE).
+# With ws_norm ~ [p(x,z_i)/q(z_i|x)]^(1-alpha) the encoder's gradient is SUM((alpha + (1-alpha)*ws_norm) * ws_norm * dlog_w/dz * dz/dphi),
+# while the decoder keeps SUM(ws_norm * dlog_w/dtheta)
+def dreg_grad_scale(ws_norm, alpha):
+    return alpha + (1 - alpha) * ws_norm
+
+
+# Pick the samples index = (B, M) out of every stochastic layer's (B, K, #latents) noise, giving (B, M, #latents) each
+def gather_noise(noise, index):
+    return [
+        eps.gather(1, index.unsqueeze(2).expand(-1, -1, eps.shape[2])) for eps in noise
+    ]
+
+
+# Noise of the samples (B, M) of each observation: regenerated when the model's noise is counter-based, so the full
+# noise need not outlive the scoring pass, and gathered from the full noise otherwise
+def select_noise(model, noise, samples, index=None):
+    if counter_based(model):
+        return model.sample_noise(
+            samples.shape[0],
+            samples.shape[1],
+            samples.device,
+            index=index,
+            samples=samples,
+        )
+    return gather_noise(noise, samples)
+
+
+# Training objective loss = -L_alpha, summed over a batch, specialized to its configuration at construction.
+# Calling the objective on (model, data) computes the loss; the model must expose sample_noise and log_weights.
+class Objective:
+    surrogate = staticmethod(vae_surrogate)
+
+    def __init__(self, K, alpha=0.0):
+        self.K = K
+        self.alpha = alpha
+        self.scale = 1.0 - alpha
+        self.reduce = self.surrogate
+        self.compiled_loss = None
+        # Whether to gather the weight diagnostics of track_weights for summary()
+        self.record_weights = False
+        self.reset_weight_stats()
+
+    # Everything the computation graph of the loss depends on, used to cache compiled losses.
+    def key(self):
+        return (type(self).__name__, self.K, self.alpha)
+
+    # Batch sum of -L_alpha for observations data = (B, 1, H, W), with dataset indices index = (B,) where an objective tracks them.
+    def loss(self, model, data, index=None):
+        log_w, _ = model.log_weights(data, self.K, index=index)
+        self.track_weights(log_w)
+        return -torch.sum(self.reduce(log_w, self.scale))
+
+    def __call__(self, model, data, index=None):
+        if self.compiled_loss is not None:
+            return self.compiled_loss(self, model, data, index)
+        return self.loss(model, data, index)
+
+    # Accumulate the gradient of the loss in the model's parameters.
+    def backward(self, model, data, index=None):
+        loss = self(model, data, index)
+        loss.backward()
+        return loss.detach()
+
+    # Whether loss is a plain forward computation that graph capture can handle (no hooks or explicit backward passes).
+    def compilable(self):
+        return True
+
+    # Run the model forward pass plus this objective through torch.compile from now on.
+    # Where torch.compile is unavailable, the surrogate is compiled with TorchScript instead and the model runs eagerly.
+    # Compiled losses are cached per model and configuration, so rebuilding an identical objective does not recompile;
+    # the cached function takes the objective as an argument, so it always updates the statistics of the instance that
+    # calls it. When example_data is given, one forward and backward pass is run on it to trigger compilation up front;
+    # it leaves the global RNG untouched, the model's gradients cleared and the weight diagnostics empty.
+    def compile(self, model, example_data=None):
+        if not self.compilable():
+            return self
+
+        if hasattr(torch, "compile"):
+            # The model's settings (its key, where it has one) shape the traced graph as much as the objective's do, and
+            # record_weights decides whether the graph computes the diagnostics at all
+            model_key = getattr(model, "key", tuple)()
+            key = (id(model), model_key, self.key(), self.record_weights, "inductor")
+            if key not in _COMPILED_LOSSES:
+                _COMPILED_LOSSES[key] = torch.compile(type(self).loss, dynamic=False)
+            self.compiled_loss = _COMPILED_LOSSES[key]
+        else:
+            key = (None, type(self).__name__, "torchscript")
+            if key not in _COMPILED_LOSSES:
+                _COMPILED_LOSSES[key] = torch.jit.script(self.surrogate)
+            self.reduce = _COMPILED_LOSSES[key]
+
+        if example_data is not None:
+            devices = [example_data.device] if example_data.is_cuda else []
+            # Stand-in dataset indices, for noise sources and objectives that key on them
+            index = torch.arange(example_data.shape[0], device=example_data.device)
+            with torch.random.fork_rng(devices=devices):
+                self(model, example_data, index).backward()
+            model.zero_grad()
+            self.reset_weight_stats()
+        return self
+
+    def reset_weight_stats(self):
+        self.ess_sum = 0
+        self.max_weight_sum = 0
+        self.log_weight_variance_sum = 0
+        self.num_weighted = 0
+
+    # Add the weight diagnostics of a batch's (B, K) log-weights to the running sums, when record_weights is set.
+    # The weights are the objective's own ws_norm ~ [p(x,z_i)/q(z_i|x)]^(1-alpha).
+    def track_weights(self, log_w):
+        if not self.record_weights:
+            return
+        with torch.no_grad():
+            log_w = log_w.detach()
+            ws_norm = torch.softmax(log_w * self.scale, 1)
+            # The spread of the K log-weights themselves, 0 rather than NaN for a single sample (e.g. the K=1 VAE)
+            self.record_weight_stats(
+                1 / torch.sum(ws_norm**2, 1),
+                torch.max(ws_norm, 1)[0],
+                torch.var(log_w, 1, unbiased=False),
+            )
+
+    # Add (B,) effective sample sizes 1/SUM(ws_norm^2), max normalized weights and log-weight variances to the running sums.
+    # The sums stay on the device, so a training step never waits for them.
+    def record_weight_stats(self, ess, max_weight, log_weight_variance):
+        self.ess_sum = self.ess_sum + torch.sum(ess)
+        self.max_weight_sum = self.max_weight_sum + torch.sum(max_weight)
+        self.log_weight_variance_sum = self.log_weight_variance_sum + torch.sum(
+            log_weight_variance
+        )
+        self.num_weighted += ess.shape[0]
+
+    # Statistics the objective gathered since the last call, for the epoch log. Resets them.
+    def summary(self):
+        if self.num_weighted == 0:
+            return {}
+        # Reading the sums back is the only host sync of the diagnostics
+        summary = {
+            "effective sample size": float(self.ess_sum) / self.num_weighted,
+            "max normalized weight": float(self.max_weight_sum) / self.num_weighted,
+            "log-weight variance": float(self.log_weight_variance_sum)
+            / self.num_weighted,
+        }
+        self.reset_weight_stats()
+        return summary
+
+
+# -ELBO averaged over the K samples of each observation.
+class VAEObjective(Objective):
+    surrogate = staticmethod(vae_surrogate)
+
+    def __init__(self, K, analytic_kl=False):
+        super(VAEObjective, self).__init__(K)
+        self.analytic_kl = analytic_kl
+
+    def key(self):
+        return super(VAEObjective, self).key() + (self.analytic_kl,)
+
+    def loss(self, model, data, index=None):
+        if self.analytic_kl:
+            return -torch.sum(model.elbo_analytic_kl(data, self.K, index=index))
+        return super(VAEObjective, self).loss(model, data, index)
+
+
+# -L_alpha estimated with all K importance samples of each observation.
+# With truncate_mass or truncate_top_k, all K samples are scored without gradients and the graph is rebuilt only for
+# the highest-weighted samples of each observation, with ws_norm held fixed and renormalized over them. This drops
+# SUM(ws_norm * dlog_w) of the other samples from the gradient, so summary() reports how much weight was dropped.
+class GeneralAlphaObjective(Objective):
+    surrogate = staticmethod(importance_weighted_surrogate)
+
+    def __init__(
+        self,
+        K,
+        alpha,
+        dreg=False,
+        chunk_size=None,
+        truncate_mass=None,
+        truncate_top_k=None,
+    ):
+        super(GeneralAlphaObjective, self).__init__(K, alpha)
+        self.dreg = dreg
+        self.chunk_size = chunk_size
+        self.truncate_mass = truncate_mass
+        self.truncate_top_k = truncate_top_k
+        self.reset_truncation_stats()
+
+    def key(self):
+        return super(GeneralAlphaObjective, self).key() + (self.dreg,)
+
+    def truncated(self):
+        return self.truncate_mass is not None or self.truncate_top_k is not None
+
+    def compilable(self):
+        # DReG registers gradient hooks, the chunked loss runs its own backward passes outside of loss,
+        # and the truncated loss picks a data-dependent number of samples
+        return not self.dreg and self.chunk_size is None and not self.truncated()
+
+    def normalized_weights(self, log_w, log_normalizer=None):
+        # ws_norm ~ [p(x,z_i)/q(z_i|x)]^(1-alpha), normalized over the row or by a precomputed log normalizer
+        if log_normalizer is None:
+            return torch.softmax(log_w * self.scale, 1)
+        return torch.exp(log_w * self.scale - log_normalizer)
+
+    def loss(self, model, data, index=None):
+        if self.truncated():
+            return self.truncated_loss(model, data, index)
+        if not self.dreg:
+            return super(GeneralAlphaObjective, self).loss(model, data, index)
+
+        log_w, _ = model.log_weights(
+            data,
+            self.K,
+            index=index,
+            dreg_scale=lambda log_w: dreg_grad_scale(
+                self.normalized_weights(log_w), self.alpha
+            ),
+        )
+
+        self.track_weights(log_w)
+
+        # loss = -SUM(ws_norm * log(p(x,z_i)/q(z_i|x))) has the decoder gradient of -L_alpha; the hooks inside log_weights turn
+        # the encoder's part of it into the DReG estimate
+        return -torch.sum(self.normalized_weights(log_w.detach()) * log_w)
+
+    def backward(self, model, data, index=None):
+        if self.chunk_size is None or self.truncated():
+            return super(GeneralAlphaObjective, self).backward(model, data, index)
+        return self.backward_chunked(model, data, index)
+
+    # -SUM(ws_norm * log(p(x,z_i)/q(z_i|x))) over the highest-weighted samples of each observation, with ws_norm held fixed.
+    # Observations that keep fewer samples than the largest count in the batch are padded with zero-weight samples,
+    # so the backward cost follows how concentrated the weights are instead of K.
+    def truncated_loss(self, model, data, index=None):
+        # Score all K samples without keeping any activations for the backward pass
+        with torch.no_grad():
+            log_w, noise = model.log_weights(data, self.K, index=index)
+            self.track_weights(log_w)
+            ws_norm = self.normalized_weights(log_w)
+            sorted_ws, order = torch.sort(ws_norm, 1, descending=True)
+
+            if self.truncate_top_k is not None:
+                num_kept = torch.full_like(
+                    order[:, 0], min(self.truncate_top_k, self.K)
+                )
+            else:
+                # Keep every sample whose higher-weighted predecessors hold less than truncate_mass between them
+                mass_before = torch.cumsum(sorted_ws, 1) - sorted_ws
+                num_kept = torch.sum(mass_before < self.truncate_mass, 1)
+
+            # The replay needs a fixed number of samples per observation, so this is the one host sync of the step
+            M = int(num_kept.max())
+            order = order[:, :M]
+            kept = torch.arange(M, device=data.device) < num_kept.unsqueeze(1)
+            kept_ws = sorted_ws[:, :M] * kept
+            kept_mass = torch.sum(kept_ws, 1, keepdim=True)
+
+            # Renormalizing ws_norm over the kept samples divides it by their mass
+            log_normalizer = torch.logsumexp(
+                log_w * self.scale, 1, keepdim=True
+            ) + torch.log(kept_mass)
+
+            # The reported loss moves by the difference between the renormalized and the full weighted sums
+            truncated_sum = torch.sum(kept_ws / kept_mass * log_w.gather(1, order), 1)
+            self.loss_bias += torch.sum(truncated_sum - torch.sum(ws_norm * log_w, 1))
+            self.dropped_mass += torch.sum(1 - kept_mass)
+            self.num_kept += torch.sum(num_kept)
+            self.num_observations += data.shape[0]
+
+        def kept_weights(log_w):
+            return self.normalized_weights(log_w, log_normalizer) * kept
+
+        if self.dreg:
+            dreg_scale = lambda log_w: dreg_grad_scale(kept_weights(log_w), self.alpha)
+        else:
+            dreg_scale = None
+
+        # Replay the kept samples with autograd on; this reproduces their entries of log_w exactly
+        log_w_kept, _ = model.log_weights(
+            data,
+            M,
+            noise=select_noise(model, noise, order, index),
+            dreg_scale=dreg_scale,
+        )
+        return -torch.sum(kept_weights(log_w_kept.detach()) * log_w_kept)
+
+    def reset_truncation_stats(self):
+        self.dropped_mass = 0
+        self.num_kept = 0
+        self.loss_bias = 0
+        self.num_observations = 0
+
+    def summary(self):
+        summary = super(GeneralAlphaObjective, self).summary()
+        if self.truncated() and self.num_observations > 0:
+            # The statistics were accumulated on the device, so reading them here is their only host sync
+            summary["dropped weight mass"] = (
+                float(self.dropped_mass) / self.num_observations
+            )
+            summary["backpropagated samples"] = (
+                float(self.num_kept) / self.num_observations
+            )
+            summary["truncated - full objective"] = (
+                float(self.loss_bias) / self.num_observations
+            )
+            self.reset_truncation_stats()
+        return summary
+
+    # Backpropagate the loss over the K samples in chunks of chunk_size, so peak memory is set by chunk_size instead of K.
+    def backward_chunked(self, model, data, index=None):
+        B = data.shape[0]
+
+        # Both passes below must see exactly the same samples. Counter-based noise is regenerated chunk by chunk, any
+        # other noise is drawn for all K samples up front; it is (B, K, #latents) per stochastic layer, which is small
+        # next to the (B, K, H*W) decoder activations
+        chunks = noise_chunks(model, B, self.K, self.chunk_size, data.device, index)
+
+        # First pass: score the chunks without a graph and keep a running max and log-sum-exp of log_w_matrix for each observation
+        with torch.no_grad():
+            running_max = torch.full((B, 1), -float("inf"), device=data.device)
+            running_sum = torch.zeros(B, 1, device=data.device)
+            # The diagnostics need the individual log-weights, which are only K floats per observation
+            log_w_chunks = []
+            for chunk_noise in chunks:
+                log_w = model.log_weights(data, self.K, noise=chunk_noise())[0]
+                if self.record_weights:
+                    log_w_chunks.append(log_w)
+                log_w_matrix = log_w * self.scale
+                new_max = torch.max(
+                    running_max, torch.max(log_w_matrix, 1, keepdim=True)[0]
+                )
+                running_sum = running_sum * torch.exp(
+                    running_max - new_max
+                ) + torch.sum(torch.exp(log_w_matrix - new_max), 1, keepdim=True)
+                running_max = new_max
+
+            # log(SUM([p(z_k,x)/q(z_k|x)]^(1-alpha))), the normalizer of ws_norm and the only state shared between chunks
+            log_normalizer = running_max + torch.log(running_sum)
+            if log_w_chunks:
+                self.track_weights(torch.cat(log_w_chunks, 1))
+
+        # Second pass: replay each chunk with a graph and backpropagate SUM(ws_norm * log(p(x,z_i)/q(z_i|x))) with ws_norm held fixed.
+        # That is the importance-weighted gradient of L_alpha, so only one chunk's activations are alive at a time
+        if self.dreg:
+            dreg_scale = lambda log_w: dreg_grad_scale(
+                self.normalized_weights(log_w, log_normalizer), self.alpha
+            )
+        else:
+            dreg_scale = None
+
+        loss = 0
+        for chunk_noise in chunks:
+            log_w = model.log_weights(
+                data, self.K, noise=chunk_noise(), dreg_scale=dreg_scale
+            )[0]
+            ws_norm = self.normalized_weights(log_w.detach(), log_normalizer)
+            chunk_loss = -torch.sum(log_w * ws_norm)
+            chunk_loss.backward()
+            loss += chunk_loss.detach()
+
+        return loss
+
+
+# -L_0, the IWAE bound, estimated with all K importance samples of each observation.
+class IWAEObjective(GeneralAlphaObjective):
+    def __init__(
+        self, K, dreg=False, chunk_size=None, truncate_mass=None, truncate_top_k=None
+    ):
+        super(IWAEObjective, self).__init__(
+            K,
+            0.0,
+            dreg=dreg,
+            chunk_size=chunk_size,
+            truncate_mass=truncate_mass,
+            truncate_top_k=truncate_top_k,
+        )
+
+
+# -L_alpha backpropagated through one selected importance sample per observation.
+class SingleSampleObjective(Objective):
+    def __init__(self, K, alpha=0.0, sparse_backprop=True):
+        super(SingleSampleObjective, self).__init__(K, alpha)
+        self.sparse_backprop = sparse_backprop
+
+    def key(self):
+        return super(SingleSampleObjective, self).key() + (self.sparse_backprop,)
+
+    # (B, 1) index of the sample to backpropagate for each observation.
+    def select(self, log_w):
+        raise NotImplementedError
+
+    def loss(self, model, data, index=None):
+        if not self.sparse_backprop:
+            return super(SingleSampleObjective, self).loss(model, data, index)
+
+        # Score all K samples without keeping any activations for the backward pass
+        with torch.no_grad():
+            log_w, noise = model.log_weights(data, self.K, index=index)
+            self.track_weights(log_w)
+            chosen = self.select(log_w)
+
+        # Pick (or regenerate) the chosen sample's noise for every stochastic layer, (B, 1, #latents) each
+        chosen_noise = select_noise(model, noise, chosen, index)
+
+        # Replay those B samples with autograd on. This reproduces the chosen entries of log_w exactly,
+        # and the (1-alpha) scaling of VR-alpha cancels out just as it does in the surrogate
+        log_w_chosen, _ = model.log_weights(data, 1, noise=chosen_noise)
+
+        return -torch.sum(log_w_chosen)
+
+
+# -L_-inf backpropagated through the maximum-weighted sample of each observation.
+class VRMaxObjective(SingleSampleObjective):
+    surrogate = staticmethod(vrmax_surrogate)
+
+    def __init__(self, K, sparse_backprop=True):
+        super(VRMaxObjective, self).__init__(K, sparse_backprop=sparse_backprop)
+
+    def select(self, log_w):
+        return log_w.argmax(1, keepdim=True)
+
+
+# -L_alpha backpropagated through one sample per observation, chosen with probability ws_norm.
+class VRAlphaObjective(SingleSampleObjective):
+    surrogate = staticmethod(vralpha_surrogate)
+
+    def __init__(self, K, alpha, sparse_backprop=True):
+        super(VRAlphaObjective, self).__init__(K, alpha, sparse_backprop)
+
+    def select(self, log_w):
+        # The same draw as vralpha_surrogate, so both paths pick the same samples from the same RNG state
+        ws_norm = torch.softmax(log_w * self.scale, 1)
+        return torch.multinomial(ws_norm, 1)
+
+
+# Exponential moving average of the variance of log(p(x,z_i)/q(z_i|x)) across the samples of each datapoint.
+# Every datapoint starts at initial_variance, so the first pass over the data treats them all alike.
+class LogWeightVarianceTracker:
+    def __init__(self, num_datapoints, device, momentum=0.9, initial_variance=1.0):
+        self.variance = torch.full((num_datapoints,), initial_variance, device=device)
+        self.momentum = momentum
+
+    # Fold new variance estimates into the datapoints index = (B,) where valid = (B,) is set.
+    def update(self, index, variance, valid):
+        old = self.variance[index]
+        self.variance[index] = torch.where(
+            valid, self.momentum * old + (1 - self.momentum) * variance, old
+        )
+
+    # Split budget samples between the datapoints index = (B,) in proportion to their tracked variance.
+    # Every datapoint gets at least min_k samples and the rest is rounded with the largest remainder method, so the
+    # counts always add up to budget without reading anything back from the device.
+    def allocate(self, index, budget, min_k=2):
+        variance = self.variance[index].clamp(min=1e-6)
+        share = (budget - min_k * index.shape[0]) * variance / torch.sum(variance)
+        counts = torch.floor(share)
+        remainder = share - counts
+        # The (budget - SUM(counts)) datapoints with the largest remainders get one more sample
+        leftover = budget - min_k * index.shape[0] - torch.sum(counts)
+        rank = torch.argsort(torch.argsort(remainder, descending=True))
+        return (counts + (rank < leftover).to(counts.dtype)).long() + min_k
+
+
+# -L_alpha with a budget of B*K samples per batch, spread over the observations in proportion to the variance of their log-weights.
+# Each observation b gets K_b samples and contributes its own L_alpha estimate with K_b samples. The variances are
+# tracked per dataset index from the samples of earlier steps (see LogWeightVarianceTracker).
+# The ragged samples are drawn as B*K rows of one sample each, so noise sources that correlate the samples of a
+# row (antithetic pairs, Sobol points) degenerate to iid noise here; counter-based noise keeps its per-sample keys.
+# The loss is backpropagated in one piece, without DReG, chunking or truncation.
+class AdaptiveKObjective(Objective):
+    surrogate = staticmethod(importance_weighted_surrogate)
+
+    def __init__(self, K, alpha, num_datapoints, device, min_k=2):
+        if K < min_k:
+            raise ValueError(
+                f"K={K} leaves less than min_k={min_k} samples per observation"
+            )
+        super(AdaptiveKObjective, self).__init__(K, alpha)
+        self.min_k = min_k
+        self.tracker = LogWeightVarianceTracker(num_datapoints, device)
+        self.max_k = 0
+        self.num_batches = 0
+
+    def compilable(self):
+        # The number of samples of each observation changes from step to step
+        return False
+
+    def loss(self, model, data, index=None):
+        B = data.shape[0]
+        budget = B * self.K
+        counts = self.tracker.allocate(index, budget, self.min_k)
+
+        # Ragged layout: the samples of all observations back to back, rows[n] is the observation of sample n
+        rows = torch.repeat_interleave(
+            torch.arange(B, device=data.device), counts, output_size=budget
+        )
+        if counter_based(model):
+            # Sample n is sample number n - (first sample of its observation) of that observation
+            first = torch.cumsum(counts, 0) - counts
+            samples = torch.arange(budget, device=data.device) - first[rows]
+            noise = model.sample_noise(
+                budget, 1, data.device, index=index[rows], samples=samples.unsqueeze(1)
+            )
+        else:
+            noise = model.sample_noise(budget, 1, data.device)
+        log_w = model.log_weights(data, 1, noise=noise, rows=rows)[0].view(budget)
+
+        # Same surrogate as importance_weighted_surrogate, with the row reductions replaced by segment reductions
+        log_w_matrix = log_w.detach() * self.scale
+        ws_norm = torch.exp(
+            log_w_matrix - segment_logsumexp(log_w_matrix, rows, B)[rows]
+        )
+        per_datapoint = segment_sum(log_w * ws_norm, rows, B)
+
+        with torch.no_grad():
+            lw = log_w.detach()
+            mean = segment_sum(lw, rows, B) / counts
+            squared_deviations = segment_sum((lw - mean[rows]) ** 2, rows, B)
+            # The tracker estimates the variance of log_w itself, so it gets the unbiased estimate
+            variance = squared_deviations / (counts - 1).clamp(min=1)
+            self.tracker.update(index, variance, counts > 1)
+            if self.record_weights:
+                ws = ws_norm.detach()
+                max_weight = torch.zeros(B, device=data.device).scatter_reduce(
+                    0, rows, ws, "amax"
+                )
+                # The diagnostics report the spread of each observation's own samples, as track_weights does
+                self.record_weight_stats(
+                    1 / segment_sum(ws**2, rows, B),
+                    max_weight,
+                    squared_deviations / counts,
+                )
+            self.max_k = self.max_k + torch.max(counts)
+            self.num_batches += 1
+
+        return -torch.sum(per_datapoint)
+
+    def summary(self):
+        summary = super(AdaptiveKObjective, self).summary()
+        if self.num_batches > 0:
+            summary["largest per-input K"] = float(self.max_k) / self.num_batches
+            summary["tracked log-weight variance"] = float(
+                torch.mean(self.tracker.variance)
+            )
+            self.max_k = 0
+            self.num_batches = 0
+        return summary
+
+
+# Build the training objective of a model type.
+# Options that do not apply to model_type are ignored.
+def make_objective(
+    model_type,
+    K,
+    alpha=0.0,
+    sparse_backprop=True,
+    dreg=False,
+    chunk_size=None,
+    analytic_kl=False,
+    truncate_mass=None,
+    truncate_top_k=None,
+    adaptive_k=False,
+    num_datapoints=None,
+    device=None,
+    adaptive_min_k=2,
+    record_weights=False,
+):
+    if model_type not in ["vae", "iwae", "vrmax", "vralpha", "general_alpha"]:
+        raise ValueError(
+            f"{model_type} isn't a valid model type! One of vae, iwae, vrmax, vralpha, general_alpha"
+        )
+
+    if adaptive_k and model_type in ["iwae", "general_alpha"]:
+        if (
+            dreg
+            or chunk_size is not None
+            or truncate_mass is not None
+            or truncate_top_k is not None
+        ):
+            raise ValueError(
+                "adaptive_k supports neither dreg, chunk_size, truncate_mass nor truncate_top_k"
+            )
+        objective = AdaptiveKObjective(
+            K,
+            0.0 if model_type == "iwae" else alpha,
+            num_datapoints,
+            device,
+            min_k=adaptive_min_k,
+        )
+    elif model_type == "vae":
+        objective = VAEObjective(K, analytic_kl=analytic_kl)
+    elif model_type == "iwae":
+        objective = IWAEObjective(
+            K,
+            dreg=dreg,
+            chunk_size=chunk_size,
+            truncate_mass=truncate_mass,
+            truncate_top_k=truncate_top_k,
+        )
+    elif model_type == "general_alpha":
+        objective = GeneralAlphaObjective(
+            K,
+            alpha,
+            dreg=dreg,
+            chunk_size=chunk_size,
+            truncate_mass=truncate_mass,
+            truncate_top_k=truncate_top_k,
+        )
+    elif model_type == "vrmax":
+        objective = VRMaxObjective(K, sparse_backprop=sparse_backprop)
+    else:
+        objective = VRAlphaObjective(K, alpha, sparse_backprop=sparse_backprop)
+
+    objective.record_weights = record_weights
+    return objective
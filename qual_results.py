@@ -12,6 +12,8 @@ import os
 import numpy as np
 import logging
 
+from example_models import test_checkpoint
+
 K = 50
 discrete_data = True
 model_type = "no"
@@ -133,6 +135,16 @@ model3.load_state_dict(
     torch.load("vae_fashion_L1_K50_M128.pt")
 )  # Choose whatever GPU device number you want
 model3.to(device)
+
+# Test NLL of each checkpoint; bounds of weights that were tested before are loaded from the evaluation cache
+for name, path in [
+    ("vrmax", "vrmax_fashion_L1_K50_M128.pt"),
+    ("iwae", "iwae_fashion_L1_K50_M128.pt"),
+    ("vae", "vae_fashion_L1_K50_M128.pt"),
+]:
+    stats = test_checkpoint(path, layers=1, name="fashion", root="../data")
+    print(f"{name} test NLL: {-torch.mean(stats['log_mean_exp']).item():.4f}")
+
 with torch.no_grad():
     sample = torch.randn(64, 50).to(device)
     result1 = model.decode(sample).cpu()
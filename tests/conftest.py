@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+import torch
+from torch import nn
+
+# The modules live at the top of the repository, next to the training scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distributions import gaussian_log_prob, standard_normal_log_prob  # noqa: E402
+
+
+class TinyModel(nn.Module):
+    def __init__(self, pixels=6, latents=3):
+        # One Gaussian stochastic layer and a Gaussian likelihood with unit variance, with the log_weights interface of
+        # the models in example_models.py
+        super(TinyModel, self).__init__()
+        self.latents = latents
+        self.encoder = nn.Linear(pixels, 2 * latents)
+        self.decoder = nn.Linear(latents, pixels)
+
+    def sample_noise(self, B, K, device, index=None, samples=None):
+        return [torch.randn(B, K, self.latents, device=device)]
+
+    def log_weights(self, data, K, noise=None, dreg_scale=None, rows=None, index=None):
+        B = data.shape[0]
+        if noise is None:
+            noise = self.sample_noise(B, K, data.device, index=index)
+        [eps] = noise
+
+        x = data.view(B, 1, -1)
+        mu, logstd = self.encoder(x).chunk(2, -1)
+        if rows is not None:
+            x, mu, logstd = x[rows], mu[rows], logstd[rows]
+        z = mu + eps * torch.exp(logstd)
+
+        if dreg_scale is None:
+            log_q = gaussian_log_prob(z, mu, logstd, axis=2)
+        else:
+            log_q = gaussian_log_prob(z, mu.detach(), logstd.detach(), axis=2)
+        log_p_z = standard_normal_log_prob(z, axis=2)
+        log_p_x = gaussian_log_prob(x, self.decoder(z), torch.zeros_like(x), axis=2)
+        log_w = log_p_z + log_p_x - log_q
+
+        if dreg_scale is not None:
+            z_grad_scale = dreg_scale(log_w.detach()).unsqueeze(2)
+            z.register_hook(lambda grad: grad * z_grad_scale)
+        return log_w, noise
+
+
+@pytest.fixture
+def tiny_model():
+    torch.manual_seed(0)
+    return TinyModel()
+
+
+@pytest.fixture
+def tiny_data():
+    torch.manual_seed(1)
+    return torch.rand(4, 1, 2, 3)
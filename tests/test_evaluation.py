@@ -0,0 +1,29 @@
+import torch
+from torch.utils.data import TensorDataset
+
+from evaluation import evaluate_sharded
+
+
+def test_sharded_evaluation_does_not_depend_on_worker_count(tiny_model):
+    torch.manual_seed(3)
+    dataset = TensorDataset(torch.rand(10, 1, 2, 3))
+    tiny_model.eval()
+
+    results = [
+        evaluate_sharded(
+            tiny_model, dataset, 16, 2**20, num_workers, 4, seed=5, ks=[1, 4]
+        )
+        for num_workers in [1, 2]
+    ]
+    for name in ["log_mean_exp", "self_normalized_mean"]:
+        assert torch.allclose(results[0][name], results[1][name])
+    assert results[0]["curve"].summary() == results[1]["curve"].summary()
+
+
+def test_sharded_evaluation_leaves_the_global_rng_alone(tiny_model):
+    dataset = TensorDataset(torch.rand(6, 1, 2, 3))
+    torch.manual_seed(7)
+    expected = torch.rand(1)
+    torch.manual_seed(7)
+    evaluate_sharded(tiny_model, dataset, 4, 2**20, 1, 4)
+    assert torch.equal(torch.rand(1), expected)
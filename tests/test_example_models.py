@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+import example_models
+from objectives import make_objective
+
+
+def binary_data(B=3):
+    torch.manual_seed(1)
+    return (torch.rand(B, 1, 28, 28) > 0.5).float()
+
+
+def gradients(objective, model, data, seed=2):
+    model.zero_grad()
+    torch.manual_seed(seed)
+    objective.backward(model, data)
+    return [parameter.grad.clone() for parameter in model.parameters()]
+
+
+def assert_same_gradients(expected, actual):
+    for grad_expected, grad_actual in zip(expected, actual):
+        assert torch.allclose(grad_expected, grad_actual, rtol=1e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize("layers", [1, 2])
+@pytest.mark.parametrize(
+    "model_type, alpha", [("vrmax", 0.5), ("vralpha", 0.5), ("vralpha", -2.0)]
+)
+def test_sparse_backprop_matches_dense(layers, model_type, alpha):
+    # From the same seed both paths draw the same noise and pick the same sample of each observation
+    torch.manual_seed(0)
+    model = example_models.build_model(layers, fused_eval_likelihood=True)
+    data = binary_data()
+
+    dense = make_objective(model_type, 6, alpha, sparse_backprop=False)
+    sparse = make_objective(model_type, 6, alpha, sparse_backprop=True)
+    assert_same_gradients(gradients(dense, model, data), gradients(sparse, model, data))
+
+
+@pytest.mark.parametrize("layers", [1, 2])
+@pytest.mark.parametrize(
+    "model_type, alpha",
+    [("iwae", 0.5), ("general_alpha", 0.5), ("general_alpha", -500.0)],
+)
+def test_chunked_gradient_matches_unchunked(layers, model_type, alpha):
+    # The chunked pass scores its samples without gradients in training mode; the fused evaluation likelihood must not
+    # take over there, or the weights of the two passes come from different kernels (alpha = -500 magnifies any gap)
+    torch.manual_seed(0)
+    model = example_models.build_model(layers, fused_eval_likelihood=True)
+    data = binary_data()
+
+    full = make_objective(model_type, 6, alpha)
+    chunked = make_objective(model_type, 6, alpha, chunk_size=4)
+    assert_same_gradients(gradients(full, model, data), gradients(chunked, model, data))
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+import example_models
+from evaluation import noise_chunks
+from noise import CounterNoise, _mulhilo32, philox4x32
+
+# Known-answer vectors of Philox4x32-10 from the Random123 distribution: (counter, key, output)
+PHILOX4X32_10_VECTORS = [
+    (
+        [0x00000000, 0x00000000, 0x00000000, 0x00000000],
+        [0x00000000, 0x00000000],
+        [0x6627E8D5, 0xE169C58D, 0xBC57AC4C, 0x9B00DBD8],
+    ),
+    (
+        [0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF],
+        [0xFFFFFFFF, 0xFFFFFFFF],
+        [0x408F276D, 0x41C83B0E, 0xA20BC7C6, 0x6D5451FD],
+    ),
+    (
+        [0x243F6A88, 0x85A308D3, 0x13198A2E, 0x03707344],
+        [0xA4093822, 0x299F31D0],
+        [0xD16CFE09, 0x94FDCCEB, 0x5001E420, 0x24126EA1],
+    ),
+]
+
+
+@pytest.mark.parametrize("counter, key, expected", PHILOX4X32_10_VECTORS)
+def test_philox_matches_known_answers(counter, key, expected):
+    words = philox4x32([torch.tensor([word]) for word in counter], key)
+    assert [int(word) for word in words] == expected
+
+
+def test_mulhilo_keeps_every_bit_of_overflowing_products():
+    # Products of two words near 2^32 overflow int64, so this relies on the multiplication wrapping around
+    a = torch.tensor([0, 1, 0x7FFFFFFF, 0x80000000, 0xD2511F53, 0xFFFFFFFF])
+    for b in [0xD2511F53, 0xCD9E8D57, 0xFFFFFFFF]:
+        hi, lo = _mulhilo32(a, b)
+        for word, word_hi, word_lo in zip(a.tolist(), hi.tolist(), lo.tolist()):
+            assert (word_hi, word_lo) == divmod(word * b, 2**32)
+
+
+def test_counter_noise_does_not_depend_on_chunking():
+    model = example_models.build_model(
+        2, train_noise="counter", counter_noise=CounterNoise(seed=3)
+    )
+    model.counter_noise.step = 5
+    index = torch.tensor([4, 0, 9])
+    device = torch.device("cpu")
+
+    whole = model.sample_noise(3, 10, device, index=index)
+    chunks = [chunk() for chunk in noise_chunks(model, 3, 10, 4, device, index)]
+    for layer, eps in enumerate(whole):
+        assert torch.equal(eps, torch.cat([chunk[layer] for chunk in chunks], 1))
+
+    # Any subset of the samples regenerates exactly the same noise, e.g. the chosen samples of a sparse backward pass
+    samples = torch.tensor([[7, 2], [0, 9], [3, 3]])
+    selected = model.sample_noise(3, 2, device, index=index, samples=samples)
+    for eps, eps_selected in zip(whole, selected):
+        expected = eps.gather(1, samples.unsqueeze(2).expand(-1, -1, eps.shape[2]))
+        assert torch.equal(eps_selected, expected)
@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from objectives import GeneralAlphaObjective, VRAlphaObjective
+
+
+def gradients(objective, model, data, seed=2):
+    model.zero_grad()
+    torch.manual_seed(seed)
+    objective.backward(model, data)
+    return [parameter.grad.clone() for parameter in model.parameters()]
+
+
+def assert_same_gradients(expected, actual):
+    for grad_expected, grad_actual in zip(expected, actual):
+        assert torch.allclose(grad_expected, grad_actual, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.5, -2.0])
+@pytest.mark.parametrize("dreg", [False, True])
+def test_chunked_gradient_matches_unchunked(tiny_model, tiny_data, alpha, dreg):
+    full = GeneralAlphaObjective(8, alpha, dreg=dreg)
+    chunked = GeneralAlphaObjective(8, alpha, dreg=dreg, chunk_size=3)
+    assert_same_gradients(
+        gradients(full, tiny_model, tiny_data),
+        gradients(chunked, tiny_model, tiny_data),
+    )
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.5, -2.0])
+@pytest.mark.parametrize("dreg", [False, True])
+def test_truncation_keeping_every_sample_matches_unchunked(
+    tiny_model, tiny_data, alpha, dreg
+):
+    full = GeneralAlphaObjective(8, alpha, dreg=dreg)
+    truncated = GeneralAlphaObjective(8, alpha, dreg=dreg, truncate_top_k=8)
+    assert_same_gradients(
+        gradients(full, tiny_model, tiny_data),
+        gradients(truncated, tiny_model, tiny_data),
+    )
+
+
+@pytest.mark.parametrize("alpha", [0.5, -2.0])
+def test_sparse_vralpha_matches_dense(tiny_model, tiny_data, alpha):
+    dense = VRAlphaObjective(8, alpha, sparse_backprop=False)
+    sparse = VRAlphaObjective(8, alpha, sparse_backprop=True)
+    assert_same_gradients(
+        gradients(dense, tiny_model, tiny_data),
+        gradients(sparse, tiny_model, tiny_data),
+    )